@@ -0,0 +1,241 @@
+"""قياس أداء المعالجات دون اتصال بـ Telegram.
+
+يمرر تحديثات Message/CallbackQuery مصطنعة عبر نفس الـ Dispatcher الموجود في bot.py،
+مع Bot API وهمي (لا طلبات شبكة)، على قاعدة بيانات مؤقتة مملوءة بحجم قابل للضبط،
+ثم يطبع الإنتاجية وزمن الاستجابة p50/p95/p99 لكل معالج.
+
+مثال:
+    python bench.py --users 50000 --products 2000 --orders 200000 --iterations 2000
+    python bench.py --scenarios buy_item,show_products_in_category --api-latency 30
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+SCENARIOS = (
+    'start', 'my_profile', 'show_categories', 'show_products_in_category',
+    'buy_item', 'order_history', 'order_history_page', 'search', 'send_broadcast',
+    'cancel_race',
+)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline handler benchmark with a fake Bot API")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--orders", type=int, default=50000)
+    parser.add_argument("--stock", type=int, default=0, help="deliverable stock items per product")
+    parser.add_argument("--iterations", type=int, default=1000, help="updates per scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="updates in flight at once")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency (ms)")
+    parser.add_argument("--broadcast-rate", type=float, default=10000.0, help="BROADCAST_RATE for the broadcast run")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--db", help="database path (default: a fresh temporary file)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+args = parse_args()
+random.seed(args.seed)
+
+# يجب ضبط البيئة قبل استيراد bot.py (التوكن وملف قاعدة البيانات يُقرآن عند الاستيراد)
+DB_PATH = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-"), "store.db")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKBENCHMARKBENCHMARKBENCH")
+os.environ["DB_NAME"] = DB_PATH
+os.environ["BROADCAST_RATE"] = str(args.broadcast_rate)
+
+import bot as store  # noqa: E402
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+
+# ------------ Fake Bot API ------------
+_message_ids = itertools.count(1)
+api_calls = {}
+
+async def fake_request(method, data=None, files=None, **kwargs):
+    api_calls[method] = api_calls.get(method, 0) + 1
+    if args.api_latency:
+        await asyncio.sleep(args.api_latency / 1000)
+    if method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+        chat_id = int((data or {}).get("chat_id", 1))
+        return {"message_id": next(_message_ids), "date": 0,
+                "chat": {"id": chat_id, "type": "private"}, "text": (data or {}).get("text", "")}
+    if method == "copyMessage":
+        return {"message_id": next(_message_ids)}
+    return True
+
+store.bot.request = fake_request
+
+# ------------ Seed Data ------------
+def seed_database():
+    store.init_db()
+    conn = sqlite3.connect(DB_PATH)
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)",
+                         [(f"Bench category {i}",) for i in range(args.categories)])
+        category_ids = [row[0] for row in conn.execute("SELECT id FROM categories")]
+        conn.executemany("INSERT INTO products (name, price, category_id) VALUES (?, ?, ?)",
+                         [(f"Product {i}", round(random.uniform(1, 50), 2), random.choice(category_ids))
+                          for i in range(args.products)])
+        conn.executemany("INSERT OR IGNORE INTO users (id, balance) VALUES (?, ?)",
+                         [(user_id, 1_000_000.0) for user_id in range(1, args.users + 1)])
+        conn.executemany("INSERT INTO orders (user_id, product_name, price) VALUES (?, ?, ?)",
+                         [(random.randint(1, args.users), f"Product {random.randrange(args.products)}",
+                           round(random.uniform(1, 50), 2)) for _ in range(args.orders)])
+    product_ids = [row[0] for row in conn.execute("SELECT id FROM products")]
+    with conn:
+        conn.executemany("INSERT INTO product_stock (product_id, content) VALUES (?, ?)",
+                         [(pid, f"KEY-{pid}-{i}") for pid in product_ids for i in range(args.stock)])
+    conn.close()
+    # إعادة التهيئة لتحميل الذاكرات المؤقتة (الإعدادات، الكتالوج، القوائم) من البيانات الجديدة
+    store.init_db()
+    return category_ids, product_ids
+
+# ------------ Synthetic Updates ------------
+_update_ids = itertools.count(1)
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "Bench"}
+
+def message_update(user_id, text):
+    message = {"message_id": next(_message_ids), "date": 0, "chat": {"id": user_id, "type": "private"},
+               "from": _user(user_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return types.Update(update_id=next(_update_ids), message=message)
+
+def callback_update(user_id, data):
+    return types.Update(update_id=next(_update_ids), callback_query={
+        "id": str(next(_update_ids)), "from": _user(user_id), "chat_instance": "bench", "data": data,
+        "message": {"message_id": next(_message_ids), "date": 0,
+                    "chat": {"id": user_id, "type": "private"}, "text": "bench"}})
+
+def make_update(scenario, category_ids, product_ids):
+    user_id = random.randint(1, args.users)
+    if scenario == 'start':
+        return message_update(user_id, "/start")
+    if scenario == 'my_profile':
+        return callback_update(user_id, "my_profile")
+    if scenario == 'show_categories':
+        return callback_update(user_id, "show_categories")
+    if scenario == 'show_products_in_category':
+        return callback_update(user_id, f"view_products_{random.choice(category_ids)}")
+    if scenario == 'buy_item':
+        return callback_update(user_id, f"buy_{random.choice(product_ids)}")
+    if scenario == 'order_history':
+        return callback_update(user_id, "order_history")
+    if scenario == 'order_history_page':
+        # صفحة أقدم بفلتر عشوائي (ترقيم keyset من id عشوائي)
+        status = random.choice(tuple(store.ORDER_HISTORY_FILTERS))
+        return callback_update(user_id, f"history_{status}_{random.randint(1, args.orders)}")
+    if scenario == 'search':
+        return message_update(user_id, f"/search Product {random.randrange(args.products)}")
+    if scenario == 'send_broadcast':
+        return message_update(store.ADMIN_ID, "bench broadcast")
+    raise ValueError(scenario)
+
+# ------------ Runner ------------
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+async def process(update, latencies):
+    start = time.perf_counter()
+    await store.dp.process_update(update)
+    latencies.append(time.perf_counter() - start)
+
+async def check_cancel_race(rounds=20, taps=3):
+    """فحص انحدار: ضغطات إلغاء متزامنة على نفس الطلب تُعيد المبلغ مرة واحدة فقط."""
+    conn = sqlite3.connect(DB_PATH)
+    with conn:
+        # منتج بلا مخزون حتى يبقى الطلب قابلاً للإلغاء
+        product_id = conn.execute("INSERT INTO products (name, price, category_id) VALUES ('Cancel race', 10, NULL)").lastrowid
+    failures = 0
+    for _ in range(rounds):
+        user_id = random.randint(1, args.users)
+        before = await store.get_user_balance(user_id)
+        await store.dp.process_update(callback_update(user_id, f"buy_{product_id}"))
+        order_id = conn.execute("SELECT MAX(id) FROM orders WHERE user_id = ?", (user_id,)).fetchone()[0]
+        # تجاوز حدود الـ throttling: المطلوب هنا سباق قاعدة البيانات لا معدل الضغط
+        store.throttling.buckets.clear()
+        await asyncio.gather(*[asyncio.create_task(store.dp.process_update(callback_update(user_id, f"cancel_{order_id}")))
+                               for _ in range(taps)])
+        after = await store.get_user_balance(user_id)
+        refunds = conn.execute("SELECT COUNT(*) FROM balance_ledger WHERE order_id = ? AND type = 'refund'", (order_id,)).fetchone()[0]
+        if abs(after - before) > 0.005 or refunds != 1:
+            failures += 1
+            print(f"cancel_race: user {user_id} order {order_id}: balance {before:.2f} -> {after:.2f}, refunds {refunds}")
+    conn.close()
+    print(f"{'cancel_race':<28}{rounds:>8}   {'OK' if not failures else f'{failures} FAILED'} ({taps} concurrent cancels per order)")
+    return failures
+
+async def run_scenario(scenario, category_ids, product_ids):
+    if scenario == 'cancel_race':
+        if await check_cancel_race():
+            sys.exit(1)
+        return
+    latencies = []
+    concurrency = 1 if scenario == 'send_broadcast' else args.concurrency
+    iterations = 1 if scenario == 'send_broadcast' else args.iterations
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            if scenario == 'send_broadcast':
+                await store.dp.storage.set_state(chat=store.ADMIN_ID, user=store.ADMIN_ID,
+                                                 state=store.BroadcastFlow.waiting_for_message.state)
+            # كل تحديث في مهمة مستقلة كما في polling/webhook (سياق FSM منفصل)
+            await asyncio.create_task(process(make_update(scenario, category_ids, product_ids), latencies))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(iterations)])
+    elapsed = time.perf_counter() - started
+    report(scenario, latencies, elapsed)
+
+    if scenario == 'send_broadcast':
+        # زمن إكمال مهمة البث في الخلفية لجميع المستخدمين
+        started = time.perf_counter()
+        await asyncio.gather(*list(store._background_tasks))
+        elapsed = time.perf_counter() - started
+        print(f"{'broadcast_job':<28}{args.users:>8}{args.users / elapsed:>12.1f}{'':>10}{'':>10}{'':>10}"
+              f"   total {elapsed:.2f}s (rate limit {args.broadcast_rate:g}/s)")
+
+def report(name, latencies, elapsed):
+    values = sorted(latencies)
+    print(f"{name:<28}{len(values):>8}{len(values) / elapsed:>12.1f}"
+          f"{percentile(values, 50) * 1000:>10.2f}{percentile(values, 95) * 1000:>10.2f}"
+          f"{percentile(values, 99) * 1000:>10.2f}")
+
+async def main():
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    Bot.set_current(store.bot)
+    Dispatcher.set_current(store.dp)
+
+    started = time.perf_counter()
+    category_ids, product_ids = await asyncio.get_running_loop().run_in_executor(None, seed_database)
+    print(f"Seeded {DB_PATH}: {args.users} users, {len(category_ids)} categories, "
+          f"{len(product_ids)} products, {args.orders} orders in {time.perf_counter() - started:.1f}s")
+    print(f"API latency: {args.api_latency:g} ms, concurrency: {args.concurrency}\n")
+    print(f"{'handler':<28}{'n':>8}{'ops/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+
+    for scenario in scenarios:
+        await run_scenario(scenario, category_ids, product_ids)
+
+    print("\nBot API calls:", ", ".join(f"{method}={count}" for method, count in sorted(api_calls.items())))
+    await store.flush_user_activity()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    finally:
+        store.close_db()
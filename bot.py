@@ -1,35 +1,536 @@
-Import logging
+import logging
 import sqlite3
 import random
 import os  # *** تأكد من وجود هذا السطر لاستخدام التوكن من البيئة ***
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.handler import CancelHandler, ctx_data, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.utils.exceptions import BadRequest, RetryAfter, TelegramAPIError
+from aiohttp import web
 from datetime import datetime, timedelta
 import asyncio
+import copy
+import csv
+import functools
+import gzip
+import html
+import inspect
+import itertools
+import json
+import math
+import re
+import signal
+import sys
+import tempfile
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # ------------ Config ------------
 # تم تحديث التوكن ومعرف الأدمن الخاص بك
 # يجب أن يكون TOKEN = os.environ.get("BOT_TOKEN") بدلاً من API_TOKEN
 TOKEN = os.environ.get("BOT_TOKEN") 
 ADMIN_ID = 7549947471 
+# عنوان بديل لـ Bot API (خادم محلي أو خادم اختبار وهمي)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
 
 logging.basicConfig(level=logging.INFO)
 
+# ------------ Metrics ------------
+# مدرجات تكرارية (histograms) لزمن كل معالج، وكل دالة قاعدة بيانات، وكل طلب إلى Bot API.
+# تُعرض عبر أمر /metrics للأدمن، وعبر خادم HTTP محلي إن ضُبط METRICS_PORT (معطَّل افتراضياً).
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # ثوانٍ
+
+class LatencyHistogram:
+    """عدّادات تراكمية بحدود ثابتة: التسجيل O(عدد الحدود) بلا تخزين للعينات."""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # الخانة الأخيرة: أكبر من آخر حد
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct):
+        """تقدير المئين بالحد الأعلى للخانة التي يقع فيها (أو أكبر قيمة مسجلة)."""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * pct / 100)
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+# الأنواع: handler (معالجات التحديثات)، db (دوال قاعدة البيانات)، telegram (طرق Bot API)
+_metrics = {'handler': {}, 'db': {}, 'telegram': {}}
+_metrics_started = time.time()
+
+def observe_latency(kind, name, seconds):
+    histogram = _metrics[kind].get(name)
+    if histogram is None:
+        histogram = _metrics[kind][name] = LatencyHistogram()
+    histogram.observe(seconds)
+
+def render_prometheus_metrics():
+    """نص بصيغة Prometheus لجميع المدرجات."""
+    lines = []
+    labels = {'handler': 'handler', 'db': 'function', 'telegram': 'method'}
+    for kind, histograms in _metrics.items():
+        metric = f"bot_{kind}_latency_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for name, histogram in sorted(histograms.items()):
+            label = f'{labels[kind]}="{name}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum{{{label}}} {histogram.total:.6f}")
+            lines.append(f"{metric}_count{{{label}}} {histogram.count}")
+    lines.append(f"bot_uptime_seconds {time.time() - _metrics_started:.0f}")
+    return "\n".join(lines) + "\n"
+
+def metrics_summary(limit=8):
+    """ملخص نصي للأدمن: أكثر العناصر استهلاكاً للوقت الإجمالي في كل نوع."""
+    titles = {'handler': "⏱ المعالجات", 'db': "🗄 قاعدة البيانات", 'telegram': "📡 Telegram API"}
+    uptime = timedelta(seconds=int(time.time() - _metrics_started))
+    text = f"📈 مقاييس الأداء (منذ {uptime}):\n"
+    for kind, histograms in _metrics.items():
+        text += f"\n{titles[kind]}:\n"
+        top = sorted(histograms.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+        if not top:
+            text += "   —\n"
+        for name, h in top:
+            text += (f"   • {name}: {h.count}× | p50 {h.percentile(50) * 1000:.1f} | "
+                     f"p95 {h.percentile(95) * 1000:.1f} | p99 {h.percentile(99) * 1000:.1f} | "
+                     f"max {h.max * 1000:.1f} ms\n")
+    return text
+
+class InstrumentedBot(Bot):
+    """Bot يسجل زمن كل طلب إلى Bot API (send_message، copy_message، ...) حسب اسم الطريقة."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        finally:
+            observe_latency('telegram', method, time.perf_counter() - start)
+
+class MetricsMiddleware(BaseMiddleware):
+    """تسجيل زمن المعالج الذي طابق التحديث فعلاً (بعد نجاح الفلاتر)."""
+
+    async def trigger(self, action, args):
+        if action.startswith("process_"):
+            # data هو آخر عنصر؛ current_handler مضبوط هنا فقط (يُعاد ضبطه قبل post_process)
+            args[-1]['_metrics'] = (current_handler.get().__name__, time.perf_counter())
+        elif action.startswith("post_process_"):
+            started = args[-1].get('_metrics')
+            if started:
+                observe_latency('handler', started[0], time.perf_counter() - started[1])
+
+def rename_current_handler(name):
+    """للموجّهات الداخلية: نسب زمن التحديث الجاري إلى المعالج الفعلي لا إلى الموجّه."""
+    data = ctx_data.get()
+    if data and '_metrics' in data:
+        data['_metrics'] = (name, data['_metrics'][1])
+
+async def handle_metrics(request):
+    return web.Response(text=render_prometheus_metrics(), content_type="text/plain")
+
+async def start_metrics_server():
+    """خادم HTTP محلي لـ /metrics (يُرجع الـ runner لإيقافه عند الإغلاق)."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    logging.info("Serving metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
 # يجب استخدام TOKEN بدلاً من API_TOKEN
-bot = Bot(token=TOKEN) 
-dp = Dispatcher(bot, storage=MemoryStorage())
+bot = InstrumentedBot(token=TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION) 
 
 # ------------ Database Setup (SQLite) ------------
-DB_NAME = 'store.db'
+DB_NAME = os.environ.get("DB_NAME", "store.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+
+# منفذ مخصص لقاعدة البيانات: كل خيط يحتفظ باتصال دائم واحد (مجمع اتصالات)
+# حتى لا تُحجب حلقة الأحداث أثناء تنفيذ الاستعلامات.
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+_db_local = threading.local()
+_db_connections = []
+_db_connections_lock = threading.Lock()
+
+def get_connection():
+    """إرجاع اتصال الخيط الحالي بقاعدة البيانات (يُنشأ مرة واحدة لكل خيط)."""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
+
+@contextmanager
+def transaction(conn):
+    """معاملة صريحة (BEGIN IMMEDIATE) تُثبَّت عند النجاح وتُلغى عند أي خطأ."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
 
-def init_db():
-    """تهيئة قاعدة البيانات وإنشاء جميع الجداول."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def db_task(func):
+    """تحويل دالة قاعدة بيانات متزامنة إلى دالة awaitable تعمل في منفذ قاعدة البيانات."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # الزمن المسجل يشمل الانتظار في طابور المنفذ، وهو ما يلمسه المعالج فعلاً
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+        finally:
+            observe_latency('db', func.__name__, time.perf_counter() - start)
+    return wrapper
+
+def close_db():
+    """إيقاف منفذ قاعدة البيانات وإغلاق جميع الاتصالات المفتوحة."""
+    _db_executor.shutdown(wait=True)
+    with _db_connections_lock:
+        for conn in _db_connections:
+            conn.close()
+        _db_connections.clear()
+
+# ------------ FSM Storage (SQLite) ------------
+# حالات المحادثة (FSM) محفوظة في قاعدة البيانات فلا تضيع عند إعادة التشغيل، مع
+# ذاكرة LRU محدودة أمامها للمستخدمين النشطين. الحالات المهجورة تُحذف بعد FSM_STATE_TTL.
+FSM_CACHE_SIZE = int(os.environ.get("FSM_CACHE_SIZE", "10000"))
+FSM_STATE_TTL = int(os.environ.get("FSM_STATE_TTL", str(24 * 60 * 60)))
+
+@db_task
+def load_fsm_record(chat_id, user_id):
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT state, data, bucket, updated_at FROM fsm_storage WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+    row = cursor.fetchone()
+    if row:
+        state, data, bucket, updated_at = row
+        return {'state': state, 'data': json.loads(data), 'bucket': json.loads(bucket), 'updated_at': updated_at}
+    return None
+
+@db_task
+def save_fsm_record(chat_id, user_id, state, data, bucket, updated_at):
+    # شرط updated_at يمنع كتابة أقدم (من خيط آخر في المنفذ) من تجاوز كتابة أحدث
+    conn = get_connection()
+    conn.execute("""
+        INSERT INTO fsm_storage (chat_id, user_id, state, data, bucket, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            state = excluded.state, data = excluded.data, bucket = excluded.bucket, updated_at = excluded.updated_at
+        WHERE excluded.updated_at >= fsm_storage.updated_at
+    """, (chat_id, user_id, state, data, bucket, updated_at))
+
+@db_task
+def delete_stale_fsm_records(cutoff):
+    conn = get_connection()
+    cursor = conn.execute("""
+        DELETE FROM fsm_storage
+        WHERE updated_at < ? OR (state IS NULL AND data = '{}' AND bucket = '{}')
+    """, (cutoff,))
+    return cursor.rowcount
+
+class SQLiteStorage(BaseStorage):
+    """مخزن حالات FSM في SQLite مع ذاكرة LRU (كتابة فورية إلى قاعدة البيانات)."""
+
+    def __init__(self, cache_size=FSM_CACHE_SIZE, ttl=FSM_STATE_TTL):
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._cache = OrderedDict()  # (chat_id, user_id) -> record
+
+    def _empty_record(self):
+        return {'state': None, 'data': {}, 'bucket': {}, 'updated_at': time.time()}
+
+    async def _get_record(self, chat, user):
+        key = self.check_address(chat=chat, user=user)
+        record = self._cache.get(key)
+        if record is None:
+            loaded = await load_fsm_record(*key) or self._empty_record()
+            # قد يكون طلب آخر لنفس المستخدم ملأ الذاكرة أثناء الانتظار
+            record = self._cache.setdefault(key, loaded)
+        if record['updated_at'] < time.time() - self.ttl:
+            record.update(self._empty_record())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return key, record
+
+    async def _save(self, key, record):
+        record['updated_at'] = time.time()
+        await save_fsm_record(*key, record['state'], json.dumps(record['data']),
+                              json.dumps(record['bucket']), record['updated_at'])
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, record = await self._get_record(chat, user)
+        state = record['state']
+        return state if state is not None else self.resolve_state(default)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = await self._get_record(chat, user)
+        state = self.resolve_state(state)
+        if state == record['state']:
+            return  # لا كتابة عند عدم التغيير (مثلاً state.finish() في كل /start)
+        record['state'] = state
+        await self._save(key, record)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, record = await self._get_record(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, record = await self._get_record(chat, user)
+        data = copy.deepcopy(data) if data else {}
+        if data == record['data']:
+            return
+        record['data'] = data
+        await self._save(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, record = await self._get_record(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        await self._save(key, record)
+
+    def has_bucket(self):
+        return True
 
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, record = await self._get_record(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, record = await self._get_record(chat, user)
+        bucket = copy.deepcopy(bucket) if bucket else {}
+        if bucket == record['bucket']:
+            return
+        record['bucket'] = bucket
+        await self._save(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key, record = await self._get_record(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        await self._save(key, record)
+
+    async def evict_expired(self):
+        """حذف الحالات المهجورة من قاعدة البيانات ومن الذاكرة."""
+        cutoff = time.time() - self.ttl
+        for key in [key for key, record in self._cache.items() if record['updated_at'] < cutoff]:
+            del self._cache[key]
+        return await delete_stale_fsm_records(cutoff)
+
+    async def close(self):
+        self._cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+# ------------ Throttling ------------
+# دلو رموز لكل (مستخدم، عائلة): العائلة هي بادئة callback_data (buy_، view_products_ ...)
+# أو "message" للرسائل، وإلا "*". الصيغة: "بادئة:معدل/سعة" (المعدل برموز في الثانية).
+THROTTLE_LIMITS = os.environ.get("THROTTLE_LIMITS", "buy_:0.5/3,cancel_:0.5/3,view_products_:3/10,message:2/8,*:4/12")
+THROTTLE_SWEEP_INTERVAL = int(os.environ.get("THROTTLE_SWEEP_INTERVAL", "300"))
+
+def parse_throttle_limits(spec):
+    limits = {}
+    for item in spec.split(","):
+        family, _, limit = item.strip().rpartition(":")
+        rate, _, burst = limit.partition("/")
+        # رصيد أقل من ضغطة كاملة (مثل buy_:0.5 دون burst) يحظر العائلة للمستخدم إلى الأبد
+        limits[family] = (float(rate), max(1.0, float(burst or rate)))
+    return limits
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """رفض التحديثات الزائدة قبل الفلاتر وأي استعلام، مع رد "تمهّل" رخيص."""
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits
+        # البادئات الأطول أولاً حتى تُطابق view_products_ قبل أي بادئة أقصر منها
+        self.prefixes = sorted((f for f in limits if f not in ('message', '*')), key=len, reverse=True)
+        # (user_id, family) -> [tokens, last_seen, warned]
+        self.buckets = {}
+
+    def family(self, data):
+        for prefix in self.prefixes:
+            if data.startswith(prefix):
+                return prefix
+        return '*'
+
+    def allow(self, user_id, family):
+        """True إن توفر رمز؛ وإلا False مع warned السابقة (لتجنب تكرار التنبيه)."""
+        rate, burst = self.limits.get(family) or self.limits['*']
+        now = time.monotonic()
+        bucket = self.buckets.get((user_id, family))
+        if bucket is None:
+            self.buckets[(user_id, family)] = [burst - 1, now, False]
+            return True, False
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True, False
+        warned, bucket[2] = bucket[2], True
+        return False, warned
+
+    def evict_idle(self):
+        """حذف الدلاء التي امتلأت مجدداً: حذفها لا يغير شيئاً لأنها ستُنشأ ممتلئة."""
+        now = time.monotonic()
+        idle = []
+        for key, (tokens, last_seen, _) in self.buckets.items():
+            rate, burst = self.limits.get(key[1]) or self.limits['*']
+            if tokens + (now - last_seen) * rate >= burst:
+                idle.append(key)
+        for key in idle:
+            del self.buckets[key]
+        return len(idle)
+
+    async def on_pre_process_message(self, msg: types.Message, data):
+        if msg.from_user.id == ADMIN_ID:
+            return
+        allowed, warned = self.allow(msg.from_user.id, 'message')
+        if not allowed:
+            if not warned:
+                await msg.answer("⏳ تمهّل قليلاً، أرسلت رسائل كثيرة بسرعة.")
+            raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, cb: types.CallbackQuery, data):
+        if cb.from_user.id == ADMIN_ID:
+            return
+        allowed, _ = self.allow(cb.from_user.id, self.family(cb.data or ''))
+        if not allowed:
+            # الرد على الاستدعاء ضروري لإيقاف مؤشر التحميل، ولا يلمس قاعدة البيانات
+            await cb.answer("⏳ تمهّل قليلاً...")
+            raise CancelHandler()
+
+dp = Dispatcher(bot, storage=SQLiteStorage())
+dp.middleware.setup(MetricsMiddleware())
+throttling = ThrottlingMiddleware(parse_throttle_limits(THROTTLE_LIMITS))
+dp.middleware.setup(throttling)
+
+# ------------ Callback Router ------------
+# توجيه callback_data بجدول مفاتيح ثابتة + شجرة بادئات (trie) بدلاً من فحص عشرات
+# الفلاتر بالترتيب. البادئة تُمرر بقيتها للمعالج كوسائط مُحوّلة مسبقاً (buy_<int> ...).
+class CallbackRouter:
+    """موجّه callback_query: تطابق تام أولاً، ثم أطول بادئة، مع احترام state لكل معالج."""
+
+    def __init__(self):
+        self._exact = {}  # data -> [route]
+        self._trie = {}  # حرف -> عقدة؛ المفتاح '' في العقدة يحمل مسارات البادئة المنتهية عندها
+
+    @staticmethod
+    def _route(handler, converters, state):
+        params = inspect.signature(handler).parameters
+        required = sum(1 for p in params.values() if p.default is p.empty) - 1 - ('state' in params)
+        if state == "*":
+            states = "*"
+        else:
+            states = set()
+            for item in (state if isinstance(state, (list, tuple)) else [state]):
+                if isinstance(item, State):
+                    states.add(item.state)
+                elif isinstance(item, type) and issubclass(item, StatesGroup):
+                    states.update(item.all_states_names)
+                else:
+                    states.add(item)
+        return (handler, converters, states, 'state' in params, required)
+
+    def exact(self, data, state=None):
+        def decorator(handler):
+            self._exact.setdefault(data, []).append(self._route(handler, (), state))
+            return handler
+        return decorator
+
+    def prefix(self, prefix, *converters, state=None):
+        """المعالج يستقبل بقية البيانات مقسومة على "_" (آخر وسيط يأخذ الباقي كاملاً)."""
+        def decorator(handler):
+            node = self._trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault('', []).append((len(prefix),) + self._route(handler, converters, state))
+            return handler
+        return decorator
+
+    def _candidates(self, data):
+        for route in self._exact.get(data, ()):
+            yield route, ()
+        matches = []
+        node = self._trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            if '' in node:
+                matches.append(node[''])
+        for routes in reversed(matches):  # الأطول أولاً
+            for length, *route in routes:
+                handler, converters, states, wants_state, required = route
+                suffix = data[length:]
+                parts = suffix.split('_', len(converters) - 1) if suffix and converters else []
+                try:
+                    args = tuple(convert(part) for convert, part in zip(converters, parts))
+                except ValueError:
+                    continue
+                if len(args) >= required:
+                    yield route, args
+
+    async def dispatch(self, cb: types.CallbackQuery, state: FSMContext):
+        current = ...  # تُقرأ الحالة عند أول حاجة فقط
+        for (handler, converters, states, wants_state, required), args in self._candidates(cb.data or ''):
+            if states != "*":
+                if current is ...:
+                    current = await state.get_state()
+                if current not in states:
+                    continue
+            rename_current_handler(handler.__name__)
+            if wants_state:
+                return await handler(cb, *args, state=state)
+            return await handler(cb, *args)
+        rename_current_handler("unmatched_callback")
+
+callbacks = CallbackRouter()
+dp.register_callback_query_handler(callbacks.dispatch, state="*")
+
+# ------------ Schema Migrations ------------
+# كل ترحيل يُطبَّق مرة واحدة وبالترتيب داخل معاملة خاصة به، ورقم نسخة المخطط
+# محفوظ في قاعدة البيانات نفسها (PRAGMA user_version).
+# لا تعدّل ترحيلاً تم نشره؛ أضف ترحيلاً جديداً برقم أعلى في آخر القائمة.
+
+def _migration_1_base_tables(cursor):
     # 1. جدول الأقسام
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS categories (
@@ -97,6 +598,309 @@ def init_db():
         )
     """)
 
+def _migration_2_hot_path_indexes(cursor):
+    # سجل الطلبات: WHERE user_id = ? ORDER BY timestamp DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_timestamp ON orders (user_id, timestamp)")
+    # نافذة الإلغاء: WHERE user_id = ? AND expiry_time > ?
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cancellable_orders_user_expiry ON cancellable_orders (user_id, expiry_time)")
+    # منتجات القسم: WHERE category_id = ? ORDER BY id DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_category ON products (category_id, id)")
+
+def _migration_3_broadcast_jobs(cursor):
+    # مهام البث الجماعي: التقدم محفوظ (آخر ID تمت معالجته) لاستئناف البث بعد إعادة التشغيل
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'Running',
+            total_users INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )
+    """)
+
+def _migration_4_cancellation_windows(cursor):
+    # علامة على الطلب نفسه تبيّن هل ما زال قابلاً للإلغاء، وفهرس على expiry_time
+    # ليحذف الكنّاس النوافذ المنتهية دفعة واحدة دون مسح الجدول كاملاً
+    cursor.execute("ALTER TABLE orders ADD COLUMN cancellable INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cancellable_orders_expiry ON cancellable_orders (expiry_time)")
+    cursor.execute("""
+        UPDATE orders SET cancellable = 1
+        WHERE id IN (SELECT order_id FROM cancellable_orders WHERE expiry_time > datetime('now', 'localtime'))
+    """)
+    cursor.execute("DELETE FROM cancellable_orders WHERE expiry_time <= datetime('now', 'localtime')")
+
+def _migration_5_incremental_statistics(cursor):
+    # عدّادات الإحصائيات تُحدَّث بمشغّلات (triggers) داخل نفس معاملة الكتابة،
+    # فتبقى صحيحة مهما كان مسار الإضافة/الإلغاء/التسليم. الأيام بتوقيت UTC
+    # (تاريخ الطلب نفسه) مثل CURRENT_TIMESTAMP.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS store_stats (
+            key TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+    cursor.execute("""
+        INSERT OR REPLACE INTO store_stats (key, value)
+        SELECT 'users', COUNT(id) FROM users
+        UNION ALL SELECT 'products', COUNT(id) FROM products
+        UNION ALL SELECT 'orders', COUNT(id) FROM orders WHERE status = 'Completed'
+        UNION ALL SELECT 'revenue', COALESCE(SUM(price), 0) FROM orders WHERE status = 'Completed'
+    """)
+    cursor.execute("""
+        INSERT OR REPLACE INTO daily_stats (day, orders, revenue, cancelled, delivered)
+        SELECT date(timestamp),
+               SUM(status = 'Completed'),
+               COALESCE(SUM(CASE WHEN status = 'Completed' THEN price END), 0),
+               SUM(status = 'Cancelled'),
+               SUM(delivery_status = 'Delivered')
+        FROM orders GROUP BY date(timestamp)
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_user_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE store_stats SET value = value + 1 WHERE key = 'users';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_product_insert AFTER INSERT ON products
+        BEGIN
+            UPDATE store_stats SET value = value + 1 WHERE key = 'products';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_product_delete AFTER DELETE ON products
+        BEGIN
+            UPDATE store_stats SET value = value - 1 WHERE key = 'products';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_order_insert AFTER INSERT ON orders
+        WHEN NEW.status = 'Completed'
+        BEGIN
+            UPDATE store_stats SET value = value + 1 WHERE key = 'orders';
+            UPDATE store_stats SET value = value + NEW.price WHERE key = 'revenue';
+            INSERT INTO daily_stats (day, orders, revenue) VALUES (date(NEW.timestamp), 1, NEW.price)
+            ON CONFLICT(day) DO UPDATE SET orders = orders + 1, revenue = revenue + excluded.revenue;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_order_cancel AFTER UPDATE OF status ON orders
+        WHEN OLD.status = 'Completed' AND NEW.status = 'Cancelled'
+        BEGIN
+            UPDATE store_stats SET value = value - 1 WHERE key = 'orders';
+            UPDATE store_stats SET value = value - OLD.price WHERE key = 'revenue';
+            INSERT INTO daily_stats (day, cancelled) VALUES (date(OLD.timestamp), 1)
+            ON CONFLICT(day) DO UPDATE SET orders = orders - 1, revenue = revenue - OLD.price, cancelled = cancelled + 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_order_delivered AFTER UPDATE OF delivery_status ON orders
+        WHEN NEW.delivery_status = 'Delivered' AND OLD.delivery_status IS NOT 'Delivered'
+        BEGIN
+            INSERT INTO daily_stats (day, delivered) VALUES (date(NEW.timestamp), 1)
+            ON CONFLICT(day) DO UPDATE SET delivered = delivered + 1;
+        END
+    """)
+
+def _migration_6_fsm_storage(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            bucket TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated_at ON fsm_storage (updated_at)")
+
+def _migration_7_notifications(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            reply_markup TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_due ON notifications (status, next_attempt_at)")
+
+def _migration_8_product_stock(cursor):
+    # عناصر قابلة للتسليم لكل منتج (نص: كود/بيانات دخول، أو file_id لصورة/ملف)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS product_stock (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'text',
+            content TEXT NOT NULL,
+            order_id INTEGER,
+            added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            claimed_at DATETIME
+        )
+    """)
+    # فهرس جزئي للعناصر المتاحة فقط: حجز عنصر وعدّ المخزون لا يمرّان على العناصر المباعة
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_product_stock_available
+        ON product_stock (product_id, id) WHERE order_id IS NULL
+    """)
+
+def _migration_9_product_search(cursor):
+    # فهرس FTS5 خارجي المحتوى على products.name، تحافظ عليه المشغلات (triggers) متزامناً
+    # مع كل إضافة/حذف/تعديل، بما في ذلك الاستيراد الجماعي. إن لم تكن FTS5 متاحة في
+    # نسخة SQLite يُستخدم LIKE بدلاً منها (انظر fts_enabled).
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+            USING fts5(name, content='products', content_rowid='id', tokenize='unicode61 remove_diacritics 2')
+        """)
+    except sqlite3.OperationalError as e:
+        logging.warning("FTS5 unavailable, product search will use LIKE: %s", e)
+        return
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name) VALUES (NEW.id, NEW.name);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', OLD.id, OLD.name);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_products_fts_update AFTER UPDATE OF name ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', OLD.id, OLD.name);
+            INSERT INTO products_fts (rowid, name) VALUES (NEW.id, NEW.name);
+        END
+    """)
+    cursor.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+def _migration_10_order_history_indexes(cursor):
+    # سجل الطلبات مُرقَّم بـ keyset على orders.id لكل مستخدم، مع فلترة بالحالة أو حالة التسليم:
+    # كل صفحة تقرأ LIMIT صفوف من الفهرس مباشرة مهما كان عدد طلبات المستخدم.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders (user_id, status, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_delivery ON orders (user_id, delivery_status, id)")
+    # كان يخدم get_user_orders (ORDER BY timestamp) فقط، وقد حلّ محله الترقيم على id
+    cursor.execute("DROP INDEX IF EXISTS idx_orders_user_timestamp")
+
+def _migration_11_balance_ledger(cursor):
+    # سجل إلحاقي لكل تغيير في الرصيد، يُكتب في نفس معاملة تحديث users.balance (الرصيد المخزَّن).
+    # balance_after هو الرصيد بعد القيد، فيمكن التحقق من تسلسل القيود دون جمع السجل كله.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            amount REAL NOT NULL,
+            balance_after REAL NOT NULL,
+            order_id INTEGER,
+            actor_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id, id)")
+    # استرداد واحد فقط لكل طلب: استرداد ثانٍ يُفشل المعاملة كلها (بما فيها تحديث الرصيد)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_balance_ledger_refund
+        ON balance_ledger (order_id) WHERE type = 'refund'
+    """)
+    for action in ("UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_balance_ledger_no_{action.lower()} BEFORE {action} ON balance_ledger BEGIN
+                SELECT RAISE(ABORT, 'balance_ledger is append-only');
+            END
+        """)
+    # نقطة تدقيق لكل مستخدم: آخر قيد تم التحقق منه والرصيد عنده. التدقيق التزايدي يبدأ من
+    # أكبر ledger_id هنا، فلا يقرأ إلا القيود الجديدة.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+            user_id INTEGER PRIMARY KEY,
+            ledger_id INTEGER NOT NULL,
+            balance REAL NOT NULL,
+            checked_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_checkpoints_ledger ON ledger_checkpoints (ledger_id)")
+    # الأرصدة الحالية تصبح قيوداً افتتاحية ونقاط تدقيق أولى
+    cursor.execute("""
+        INSERT INTO balance_ledger (user_id, type, amount, balance_after)
+        SELECT id, 'opening', balance, balance FROM users WHERE balance != 0 ORDER BY id
+    """)
+    cursor.execute("""
+        INSERT INTO ledger_checkpoints (user_id, ledger_id, balance)
+        SELECT user_id, id, balance_after FROM balance_ledger WHERE type = 'opening'
+    """)
+
+def _migration_12_drop_orders_cancellable(cursor):
+    # orders.cancellable (الترحيل 4) لم يكن يُقرأ في أي مكان: الإلغاء وعرضه يعتمدان على
+    # cancellable_orders وحده، فكان كل كنس يدفع UPDATE إضافياً لعمود ميت
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(orders)")]
+    if 'cancellable' not in columns:
+        return
+    try:
+        cursor.execute("ALTER TABLE orders DROP COLUMN cancellable")
+    except sqlite3.OperationalError as e:
+        # DROP COLUMN يتطلب SQLite 3.35+؛ العمود المتبقي غير مستخدم وقيمته الافتراضية 0
+        logging.warning("Could not drop orders.cancellable, leaving it unused: %s", e)
+
+MIGRATIONS = [
+    (1, _migration_1_base_tables),
+    (2, _migration_2_hot_path_indexes),
+    (3, _migration_3_broadcast_jobs),
+    (4, _migration_4_cancellation_windows),
+    (5, _migration_5_incremental_statistics),
+    (6, _migration_6_fsm_storage),
+    (7, _migration_7_notifications),
+    (8, _migration_8_product_stock),
+    (9, _migration_9_product_search),
+    (10, _migration_10_order_history_indexes),
+    (11, _migration_11_balance_ledger),
+    (12, _migration_12_drop_orders_cancellable),
+]
+
+def apply_migrations(conn):
+    """تطبيق الترحيلات التي لم تُطبَّق بعد على قاعدة البيانات."""
+    current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        with transaction(conn) as cursor:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+        logging.info("Applied database migration %s (%s)", version, migration.__name__)
+
+def init_db():
+    """تهيئة قاعدة البيانات: تطبيق الترحيلات وإدخال الإعدادات والأقسام الافتراضية."""
+    conn = sqlite3.connect(DB_NAME, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    apply_migrations(conn)
+
     # --- الإعدادات الافتراضية ---
     settings_data = {
         'btc_wallet_link': 'bc1qxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
@@ -106,92 +910,142 @@ def init_db():
         'admin_welcome_message': 'مرحباً أيها الأدمن 👑',
         'cancellation_time_minutes': '30', 
         'faq_text': 'الأسئلة الشائعة: الإيداع يدوي ويستغرق 10-30 دقيقة.', 
-        'suggestion_thanks': 'شكراً لاقتراحك! سيتم مراجعته قريباً.'
+        'suggestion_thanks': 'شكراً لاقتراحك! سيتم مراجعته قريباً.',
+        'products_page_size': '10',
+        'low_stock_threshold': '3'
     }
     
-    for key, value in settings_data.items():
-        cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, value))
-    
     # إضافة أقسام افتراضية
     default_categories = ["بطاقات Mastercard", "بطاقات Visa", "حسابات"]
-    for cat_name in default_categories:
-        cursor.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (cat_name,))
 
-    conn.commit()
+    with transaction(conn) as cursor:
+        for key, value in settings_data.items():
+            cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        for cat_name in default_categories:
+            cursor.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (cat_name,))
+
+    global fts_enabled
+    fts_enabled = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'").fetchone() is not None
+
+    load_settings(conn)
+    catalog.load(conn)
+    load_menu_cache(conn)
     conn.close()
 
 # الدوال المساعدة لقاعدة البيانات
+# كل دالة تعمل داخل منفذ قاعدة البيانات (db_task) وتُستدعى بـ await من المعالجات.
+
+# ذاكرة مؤقتة للإعدادات: يُحمَّل جدول settings مرة واحدة ويُحدَّث عند كل كتابة،
+# فتُقرأ الإعدادات في المسارات الساخنة دون أي استعلام.
+_settings_cache = {}
+
+def load_settings(conn):
+    _settings_cache.clear()
+    _settings_cache.update(conn.execute("SELECT key, value FROM settings").fetchall())
+
 def get_setting(key):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
+    return _settings_cache.get(key)
 
+@db_task
 def set_setting(key, value):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+    _settings_cache[key] = value
 
+@db_task
 def get_user_balance(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
-    cursor.execute("UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
+    # قراءة فقط: تسجيل المستخدم وآخر نشاط له يتمّان عبر touch_user (كتابة مؤجلة)
+    cursor = get_connection().cursor()
     cursor.execute("SELECT balance FROM users WHERE id = ?", (user_id,))
-    balance = cursor.fetchone()[0]
-    conn.commit()
-    conn.close()
-    return balance
-
-def get_all_user_ids():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users")
-    ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return ids
-
-def update_user_balance(user_id, amount):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
-    conn.commit()
-    conn.close()
-
-def get_product_by_id(product_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name, price FROM products WHERE id = ?", (product_id,))
-    data = cursor.fetchone()
-    conn.close()
-    if data:
+    result = cursor.fetchone()
+    return result[0] if result else 0.00
+
+@db_task
+def save_user_activity(rows):
+    conn = get_connection()
+    with transaction(conn) as cursor:
+        cursor.executemany("""
+            INSERT INTO users (id, last_activity) VALUES (?, ?)
+            ON CONFLICT(id) DO UPDATE SET last_activity = excluded.last_activity
+        """, rows)
+
+def append_ledger_entry(cursor, user_id, entry_type, amount, order_id=None, actor_id=None):
+    """تسجيل قيد بعد تحديث users.balance مباشرة وداخل نفس المعاملة (balance_after من الرصيد المخزَّن)."""
+    cursor.execute("""
+        INSERT INTO balance_ledger (user_id, type, amount, balance_after, order_id, actor_id)
+        SELECT id, ?, ?, balance, ?, ? FROM users WHERE id = ?
+    """, (entry_type, amount, order_id, actor_id, user_id))
+
+@db_task
+def update_user_balance(user_id, amount, actor_id=None):
+    conn = get_connection()
+    with transaction(conn) as cursor:
+        cursor.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
+        cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
+        append_ledger_entry(cursor, user_id, 'admin_adjust', amount, actor_id=actor_id)
+
+# إصدار المخزون: يُؤخذ داخل معاملة الكتابة (BEGIN IMMEDIATE تسلسل الكاتبين)، فترتيب الإصدارات
+# هو ترتيب التثبيت. به ترفض لقطة الكتالوج أي عدد أقدم مما لديها مهما تأخر وصوله.
+_stock_versions = itertools.count(1)
+
+def next_stock_version():
+    return next(_stock_versions)
+
+@db_task
+def purchase_product(user_id, product_id):
+    """تنفيذ عملية الشراء كاملة في معاملة واحدة (BEGIN IMMEDIATE).
+
+    الخصم مشروط بكفاية الرصيد (UPDATE ... WHERE balance >= ?) فلا يمكن لضغطتين
+    متتاليتين أن تجعلا الرصيد سالباً. يُرجع قاموساً فيه status وهي إحدى:
+    'ok' أو 'not_found' أو 'insufficient'.
+
+    إن توفر مخزون للمنتج يُحجز أقدم عنصر في نفس المعاملة (item) ويُسلَّم فوراً، ولا
+    يكون الطلب قابلاً للإلغاء؛ وإلا يبقى الطلب بانتظار التسليم اليدوي كالسابق.
+    """
+    conn = get_connection()
+    with transaction(conn) as cursor:
+        cursor.execute("SELECT id, name, price FROM products WHERE id = ?", (product_id,))
+        data = cursor.fetchone()
+        if not data:
+            return {'status': 'not_found'}
         pid, name, price = data
-        return {"id": pid, "name": name, "price": f"{price:.2f}", "raw_price": price}
-    return None
+        product = {"id": pid, "name": name, "price": f"{price:.2f}", "raw_price": price}
+
+        cursor.execute("UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?", (price, user_id, price))
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT balance FROM users WHERE id = ?", (user_id,))
+            row = cursor.fetchone()
+            return {'status': 'insufficient', 'product': product, 'balance': row[0] if row else 0.00}
+
+        cursor.execute("SELECT id, kind, content FROM product_stock WHERE product_id = ? AND order_id IS NULL ORDER BY id LIMIT 1", (pid,))
+        item = cursor.fetchone()
+
+        cursor.execute("INSERT INTO orders (user_id, product_name, price, delivery_status) VALUES (?, ?, ?, ?)",
+                       (user_id, name, price, 'Pending'))
+        order_id = cursor.lastrowid
+        append_ledger_entry(cursor, user_id, 'purchase', -price, order_id, user_id)
+
+        expiry_time = stock_left = stock_version = None
+        if item:
+            cursor.execute("UPDATE product_stock SET order_id = ?, claimed_at = CURRENT_TIMESTAMP WHERE id = ?", (order_id, item[0]))
+            cursor.execute("SELECT COUNT(*) FROM product_stock WHERE product_id = ? AND order_id IS NULL", (pid,))
+            stock_left = cursor.fetchone()[0]
+            stock_version = next_stock_version()
+            item = {'kind': item[1], 'content': item[2]}
+        else:
+            minutes = int(get_setting('cancellation_time_minutes'))
+            expiry_time = (datetime.now() + timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
+            cursor.execute("INSERT INTO cancellable_orders (order_id, user_id, expiry_time) VALUES (?, ?, ?)", 
+                           (order_id, user_id, expiry_time))
 
-def record_order(user_id, product_name, price, is_cancellable=False):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO orders (user_id, product_name, price, delivery_status) VALUES (?, ?, ?, ?)", (user_id, product_name, price, 'Pending'))
-    order_id = cursor.lastrowid
-    
-    if is_cancellable:
-        minutes = int(get_setting('cancellation_time_minutes'))
-        expiry_time = (datetime.now() + timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute("INSERT INTO cancellable_orders (order_id, user_id, expiry_time) VALUES (?, ?, ?)", 
-                       (order_id, user_id, expiry_time))
-    
-    conn.commit()
-    conn.close()
-    return order_id
+        cursor.execute("SELECT balance FROM users WHERE id = ?", (user_id,))
+        balance = cursor.fetchone()[0]
+    return {'status': 'ok', 'product': product, 'order_id': order_id, 'balance': balance,
+            'expiry_time': expiry_time, 'item': item, 'stock_left': stock_left, 'stock_version': stock_version}
 
+@db_task
 def get_cancellable_order(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     cursor.execute("""
@@ -202,151 +1056,1044 @@ def get_cancellable_order(user_id):
         ORDER BY co.order_id DESC LIMIT 1
     """, (user_id, now))
     
-    result = cursor.fetchone()
-    conn.close()
-    return result
+    return cursor.fetchone()
 
+@db_task
 def cancel_pending_order(order_id, user_id, price):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute("DELETE FROM cancellable_orders WHERE order_id = ? AND user_id = ?", (order_id, user_id))
-    cursor.execute("UPDATE orders SET status = 'Cancelled', delivery_status = 'N/A' WHERE id = ?", (order_id,))
-    update_user_balance(user_id, price)
-    
-    conn.commit()
-    conn.close()
-    return True 
-
-def get_user_orders(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT product_name, price, timestamp, status, delivery_status FROM orders WHERE user_id = ? ORDER BY timestamp DESC LIMIT 10", (user_id,))
-    orders = cursor.fetchall()
-    conn.close()
-    return orders
-
-def get_all_products(category_id=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    """إلغاء الطلب وإعادة المبلغ مرة واحدة فقط: حذف نافذة الإلغاء (الحية) هو ما يحجز الإلغاء،
+    فضغطتان متزامنتان لا تُعيدان المبلغ مرتين. يُرجع False إن لم يعد الطلب قابلاً للإلغاء."""
+    conn = get_connection()
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with transaction(conn) as cursor:
+        cursor.execute("""
+            DELETE FROM cancellable_orders WHERE order_id = ? AND user_id = ? AND expiry_time > ?
+              AND EXISTS (SELECT 1 FROM orders WHERE id = ? AND status = 'Completed')
+        """, (order_id, user_id, now, order_id))
+        if cursor.rowcount != 1:
+            return False
+        cursor.execute("UPDATE orders SET status = 'Cancelled', delivery_status = 'N/A' WHERE id = ? AND status = 'Completed'", (order_id,))
+        cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (price, user_id))
+        append_ledger_entry(cursor, user_id, 'refund', price, order_id, user_id)
+    return True
+
+@db_task
+def expire_cancellation_windows(now):
+    """إنهاء كل نوافذ الإلغاء المنتهية دفعة واحدة، وإرجاع عددها."""
+    conn = get_connection()
+    with transaction(conn) as cursor:
+        cursor.execute("DELETE FROM cancellable_orders WHERE expiry_time <= ?", (now,))
+        expired = cursor.rowcount
+    return expired
+
+@db_task
+def get_user_orders_page(user_id, before_id=None, status=None, delivery_status=None, limit=10):
+    """صفحة من طلبات المستخدم بترقيم keyset على orders.id (الأحدث أولاً): الطلبات ذات id < before_id."""
+    cursor = get_connection().cursor()
+    query = "SELECT id, product_name, price, timestamp, status, delivery_status FROM orders WHERE user_id = ? AND id < ?"
+    params = [user_id, before_id or sys.maxsize]
+    if status:
+        query += " AND status = ?"
+        params.append(status)
+    if delivery_status:
+        query += " AND delivery_status = ?"
+        params.append(delivery_status)
+    cursor.execute(query + " ORDER BY id DESC LIMIT ?", (*params, limit))
+    return cursor.fetchall()
+
+@db_task
+def get_products_page(category_id=None, before_id=None, limit=10):
+    """صفحة منتجات بترقيم keyset على products.id (الأحدث أولاً): المنتجات ذات id < before_id."""
+    cursor = get_connection().cursor()
+    before_id = before_id or sys.maxsize
     if category_id:
-        cursor.execute("SELECT id, name, price FROM products WHERE category_id = ? ORDER BY id DESC", (category_id,))
+        cursor.execute("SELECT id, name, price FROM products WHERE category_id = ? AND id < ? ORDER BY id DESC LIMIT ?", (category_id, before_id, limit))
     else:
-        cursor.execute("SELECT id, name, price FROM products ORDER BY id DESC")
+        cursor.execute("SELECT id, name, price FROM products WHERE id < ? ORDER BY id DESC LIMIT ?", (before_id, limit))
     products_data = cursor.fetchall()
-    conn.close()
     return {pid: {"name": name, "price": f"{price:.2f}"} for pid, name, price in products_data}
 
+# البحث: FTS5 إن كان الفهرس موجوداً (يُحدد في init_db)، وإلا LIKE
+fts_enabled = False
+SEARCH_MAX_TERMS = 8
+
+def build_fts_query(text):
+    """تحويل نص المستخدم إلى استعلام FTS5 آمن: كل كلمة كبادئة بين علامتي تنصيص (AND ضمني)."""
+    terms = re.findall(r"\w+", text)[:SEARCH_MAX_TERMS]
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+@db_task
+def search_products(query, offset=0, limit=10):
+    """منتجات الأقسام الموجودة المطابقة للنص، مرتبة حسب الصلة (bm25) مع FTS5."""
+    cursor = get_connection().cursor()
+    if fts_enabled:
+        match = build_fts_query(query)
+        if not match:
+            return []
+        cursor.execute("""
+            SELECT p.id, p.name, p.price FROM products_fts
+            JOIN products p ON p.id = products_fts.rowid
+            JOIN categories c ON c.id = p.category_id
+            WHERE products_fts MATCH ?
+            ORDER BY products_fts.rank LIMIT ? OFFSET ?
+        """, (match, limit, offset))
+    else:
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        cursor.execute("""
+            SELECT p.id, p.name, p.price FROM products p
+            JOIN categories c ON c.id = p.category_id
+            WHERE p.name LIKE ? ESCAPE '\\'
+            ORDER BY p.id DESC LIMIT ? OFFSET ?
+        """, (pattern, limit, offset))
+    return cursor.fetchall()
+
+@db_task
 def add_product_to_db(name, price, category_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO products (name, price, category_id) VALUES (?, ?, ?)", (name, price, category_id))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    cursor = conn.execute("INSERT INTO products (name, price, category_id) VALUES (?, ?, ?)", (name, price, category_id))
+    return cursor.lastrowid
 
+@db_task
 def delete_product_from_db(product_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-    conn.commit()
-    return cursor.rowcount > 0
+    conn = get_connection()
+    with transaction(conn) as cursor:
+        cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        deleted = cursor.rowcount > 0
+        # العناصر المباعة تبقى مرتبطة بطلباتها؛ غير المباعة لم يعد لها منتج
+        cursor.execute("DELETE FROM product_stock WHERE product_id = ? AND order_id IS NULL", (product_id,))
+    return deleted
+
+# دوال المخزون
+@db_task
+def add_stock_items(product_id, items):
+    """إضافة عناصر (kind, content) لمنتج في معاملة واحدة؛ يُرجع (المخزون المتاح بعدها، إصداره) أو None."""
+    conn = get_connection()
+    with transaction(conn) as cursor:
+        cursor.execute("SELECT 1 FROM products WHERE id = ?", (product_id,))
+        if not cursor.fetchone():
+            return None
+        cursor.executemany("INSERT INTO product_stock (product_id, kind, content) VALUES (?, ?, ?)",
+                           [(product_id, kind, content) for kind, content in items])
+        cursor.execute("SELECT COUNT(*) FROM product_stock WHERE product_id = ? AND order_id IS NULL", (product_id,))
+        return cursor.fetchone()[0], next_stock_version()
+
+# دوال الاستيراد والتصدير الجماعي للكتالوج
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_MAX_REPORTED_ERRORS = 20
+CATALOG_COLUMNS = ('id', 'name', 'price', 'category')
+
+def _read_catalog_rows(path, fmt):
+    """قراءة الصفوف تدريجياً: (رقم السطر، قاموس) أو (رقم السطر، استثناء) لسطر JSONL تالف."""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            missing = {'name', 'price', 'category'} - {(name or '').strip().lower() for name in reader.fieldnames or []}
+            if missing:
+                raise ValueError(f"أعمدة ناقصة: {', '.join(sorted(missing))}")
+            for row in reader:
+                yield reader.line_num, {(key or '').strip().lower(): value for key, value in row.items()}
+        elif fmt == 'jsonl':
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except ValueError as e:
+                        yield line_number, e
+        else:
+            # مصفوفة JSON تُقرأ كاملة (حجم ملفات Telegram محدود بـ 20MB)
+            rows = json.load(f)
+            if not isinstance(rows, list):
+                raise ValueError("يجب أن يكون ملف JSON مصفوفة من الكائنات")
+            yield from enumerate(rows, start=1)
+
+def _validate_catalog_row(row):
+    if isinstance(row, Exception):
+        raise ValueError(f"JSON غير صالح ({row})")
+    if not isinstance(row, dict):
+        raise ValueError("الصف ليس كائناً")
+    name = str(row.get('name') or '').strip()
+    category = str(row.get('category') or '').strip()
+    if not name:
+        raise ValueError("الاسم فارغ")
+    if not category:
+        raise ValueError("القسم فارغ")
+    try:
+        price = float(str(row.get('price')).strip())
+    except ValueError:
+        raise ValueError(f"سعر غير صالح: {row.get('price')!r}")
+    if not math.isfinite(price) or price < 0:
+        raise ValueError(f"سعر غير صالح: {row.get('price')!r}")
+    product_id = row.get('id')
+    if product_id in (None, ''):
+        product_id = None
+    else:
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            raise ValueError(f"ID غير صالح: {product_id!r}")
+    return product_id, name, price, category
+
+@db_task
+def import_catalog_file(path, fmt):
+    """استيراد منتجات من ملف CSV/JSON/JSONL في معاملة واحدة بدفعات executemany.
+
+    الصفوف التي فيها id تُحدِّث المنتج الموجود، والباقي يُضاف كمنتجات جديدة.
+    الأقسام غير الموجودة تُنشأ تلقائياً. الصفوف غير الصالحة تُتجاوز وتُذكر في النتيجة،
+    وأي خطأ في بنية الملف يلغي الاستيراد كاملاً.
+    """
+    conn = get_connection()
+    result = {'inserted': 0, 'updated': 0, 'categories': 0, 'skipped': 0, 'errors': []}
+    inserts, updates = [], []
+
+    def flush(cursor):
+        if inserts:
+            cursor.executemany("INSERT INTO products (name, price, category_id) VALUES (?, ?, ?)", inserts)
+            result['inserted'] += len(inserts)
+            inserts.clear()
+        if updates:
+            cursor.executemany("UPDATE products SET name = ?, price = ?, category_id = ? WHERE id = ?", updates)
+            result['updated'] += len(updates)
+            updates.clear()
+
+    with transaction(conn) as cursor:
+        categories = {name.casefold(): cat_id for cat_id, name in cursor.execute("SELECT id, name FROM categories").fetchall()}
+        for line, row in _read_catalog_rows(path, fmt):
+            try:
+                product_id, name, price, category = _validate_catalog_row(row)
+                if product_id is not None and not cursor.execute("SELECT 1 FROM products WHERE id = ?", (product_id,)).fetchone():
+                    raise ValueError(f"لا يوجد منتج ذو ID {product_id}")
+            except ValueError as e:
+                result['skipped'] += 1
+                if len(result['errors']) < IMPORT_MAX_REPORTED_ERRORS:
+                    result['errors'].append(f"{line}: {e}")
+                continue
+
+            cat_id = categories.get(category.casefold())
+            if cat_id is None:
+                cursor.execute("INSERT INTO categories (name) VALUES (?)", (category,))
+                cat_id = categories[category.casefold()] = cursor.lastrowid
+                result['categories'] += 1
+
+            if product_id is None:
+                inserts.append((name, price, cat_id))
+            else:
+                updates.append((name, price, cat_id, product_id))
+            if len(inserts) + len(updates) >= IMPORT_BATCH_SIZE:
+                flush(cursor)
+        flush(cursor)
+    return result
+
+@db_task
+def export_catalog_csv(path):
+    """كتابة الكتالوج إلى ملف CSV صفاً صفاً من المؤشر (دون تحميله كاملاً في الذاكرة)."""
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT p.id, p.name, p.price, c.name,
+               (SELECT COUNT(*) FROM product_stock s WHERE s.product_id = p.id AND s.order_id IS NULL)
+        FROM products p LEFT JOIN categories c ON c.id = p.category_id
+        ORDER BY p.id
+    """)
+    count = 0
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CATALOG_COLUMNS + ('stock',))
+        for row in cursor:
+            writer.writerow(row)
+            count += 1
+    return count
+
+# دوال تصدير الطلبات
+EXPORT_FETCH_SIZE = int(os.environ.get("EXPORT_FETCH_SIZE", "5000"))
+ORDER_EXPORT_COLUMNS = ('id', 'user_id', 'product_name', 'price', 'timestamp', 'status', 'delivery_status')
+
+def iter_orders(conn, since=None, until=None, status=None, delivery_status=None, user_id=None):
+    """مولّد صفوف الطلبات المطابقة بترتيب id، دفعةً دفعة من المؤشر (fetchmany) دون تحميل النتيجة كاملة."""
+    query = f"SELECT {', '.join(ORDER_EXPORT_COLUMNS)} FROM orders WHERE 1 = 1"
+    params = []
+    for clause, value in (("timestamp >= ?", since), ("timestamp < ?", until), ("status = ?", status),
+                          ("delivery_status = ?", delivery_status), ("user_id = ?", user_id)):
+        if value is not None:
+            query += f" AND {clause}"
+            params.append(value)
+    cursor = conn.execute(query + " ORDER BY id", params)
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+@db_task
+def export_orders_file(path, fmt, filters):
+    """كتابة الطلبات المطابقة إلى ملف gzip (csv أو jsonl) أثناء القراءة. يعيد (عدد الطلبات، إيرادات المكتملة)."""
+    count, revenue = 0, 0.0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=6) as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(ORDER_EXPORT_COLUMNS)
+        for row in iter_orders(get_connection(), **filters):
+            if writer:
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(dict(zip(ORDER_EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+            count += 1
+            if row[5] == 'Completed':
+                revenue += row[3] or 0
+    return count, revenue
 
 # دوال الأقسام
+@db_task
 def get_all_categories():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute("SELECT id, name FROM categories ORDER BY id ASC")
-    data = cursor.fetchall()
-    conn.close()
-    return data
+    return cursor.fetchall()
 
+@db_task
 def add_category_to_db(name):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    conn = get_connection()
     try:
-        cursor.execute("INSERT INTO categories (name) VALUES (?)", (name,))
-        conn.commit()
-        return True
+        cursor = conn.execute("INSERT INTO categories (name) VALUES (?)", (name,))
+        return cursor.lastrowid
     except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+        return None
 
+@db_task
 def delete_category_from_db(category_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE products SET category_id = NULL WHERE category_id = ?", (category_id,))
-    cursor.execute("DELETE FROM categories WHERE id = ?", (category_id,))
-    conn.commit()
-    return cursor.rowcount > 0
-
-def get_category_name(category_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM categories WHERE id = ?", (category_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else "قسم غير معروف"
+    conn = get_connection()
+    with transaction(conn) as cursor:
+        cursor.execute("UPDATE products SET category_id = NULL WHERE category_id = ?", (category_id,))
+        cursor.execute("DELETE FROM categories WHERE id = ?", (category_id,))
+        deleted = cursor.rowcount > 0
+    return deleted
 
 # دوال الأزرار المخصصة
+@db_task
 def get_custom_buttons():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute("SELECT id, text, url FROM custom_buttons ORDER BY id ASC")
-    data = cursor.fetchall()
-    conn.close()
-    return data
+    return cursor.fetchall()
 
+@db_task
 def add_custom_button_to_db(text, url):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO custom_buttons (text, url) VALUES (?, ?)", (text, url))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    conn.execute("INSERT INTO custom_buttons (text, url) VALUES (?, ?)", (text, url))
 
+@db_task
 def delete_custom_button_from_db(button_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM custom_buttons WHERE id = ?", (button_id,))
-    conn.commit()
+    conn = get_connection()
+    cursor = conn.execute("DELETE FROM custom_buttons WHERE id = ?", (button_id,))
     return cursor.rowcount > 0
 
+# دوال البث الجماعي
+@db_task
+def create_broadcast_job(from_chat_id, message_id):
+    conn = get_connection()
+    with transaction(conn) as cursor:
+        total_users = cursor.execute("SELECT COUNT(id) FROM users WHERE id != ?", (ADMIN_ID,)).fetchone()[0]
+        cursor.execute("INSERT INTO broadcast_jobs (from_chat_id, message_id, total_users) VALUES (?, ?, ?)",
+                       (from_chat_id, message_id, total_users))
+        job_id = cursor.lastrowid
+    return job_id
+
+@db_task
+def get_broadcast_job(job_id):
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT id, from_chat_id, message_id, status, total_users, last_user_id, sent_count, failed_count,
+               progress_chat_id, progress_message_id
+        FROM broadcast_jobs WHERE id = ?
+    """, (job_id,))
+    row = cursor.fetchone()
+    if row:
+        keys = ('id', 'from_chat_id', 'message_id', 'status', 'total_users', 'last_user_id', 'sent_count',
+                'failed_count', 'progress_chat_id', 'progress_message_id')
+        return dict(zip(keys, row))
+    return None
+
+@db_task
+def get_running_broadcast_jobs():
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT id FROM broadcast_jobs WHERE status = 'Running' ORDER BY id ASC")
+    return [row[0] for row in cursor.fetchall()]
+
+@db_task
+def set_broadcast_progress_message(job_id, chat_id, message_id):
+    conn = get_connection()
+    conn.execute("UPDATE broadcast_jobs SET progress_chat_id = ?, progress_message_id = ? WHERE id = ?",
+                 (chat_id, message_id, job_id))
+
+@db_task
+def get_user_ids_after(last_user_id, limit):
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT id FROM users WHERE id > ? ORDER BY id ASC LIMIT ?", (last_user_id, limit))
+    return [row[0] for row in cursor.fetchall()]
+
+@db_task
+def save_broadcast_progress(job_id, last_user_id, sent, failed):
+    conn = get_connection()
+    conn.execute("""
+        UPDATE broadcast_jobs
+        SET last_user_id = ?, sent_count = sent_count + ?, failed_count = failed_count + ?
+        WHERE id = ?
+    """, (last_user_id, sent, failed, job_id))
+
+@db_task
+def finish_broadcast_job(job_id):
+    conn = get_connection()
+    conn.execute("UPDATE broadcast_jobs SET status = 'Done', finished_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+
 # دوال الإحصائيات
-def get_statistics():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    total_users = cursor.execute("SELECT COUNT(id) FROM users").fetchone()[0]
-    total_products = cursor.execute("SELECT COUNT(id) FROM products").fetchone()[0]
-    total_orders = cursor.execute("SELECT COUNT(id) FROM orders WHERE status = 'Completed'").fetchone()[0]
-    total_revenue = cursor.execute("SELECT SUM(price) FROM orders WHERE status = 'Completed'").fetchone()[0]
-    
-    conn.close()
+@db_task
+def get_statistics(days=7):
+    """قراءة العدّادات المحدَّثة تدريجياً وآخر `days` يوماً من daily_stats (دون مسح جدول الطلبات)."""
+    cursor = get_connection().cursor()
+    
+    totals = dict(cursor.execute("SELECT key, value FROM store_stats").fetchall())
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    daily = cursor.execute("""
+        SELECT day, orders, revenue, cancelled, delivered FROM daily_stats
+        WHERE day >= ? ORDER BY day DESC
+    """, (since,)).fetchall()
     
     return {
-        'users': total_users,
-        'products': total_products,
-        'orders': total_orders,
-        'revenue': total_revenue if total_revenue else 0.00
+        'users': int(totals.get('users', 0)),
+        'products': int(totals.get('products', 0)),
+        'orders': int(totals.get('orders', 0)),
+        'revenue': totals.get('revenue', 0.00),
+        'daily': [
+            {'day': day, 'orders': orders, 'revenue': revenue, 'cancelled': cancelled, 'delivered': delivered}
+            for day, orders, revenue, cancelled, delivered in daily
+        ]
     }
 
+@db_task
 def update_order_delivery_status(order_id, status):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE orders SET delivery_status = ? WHERE id = ?", (status, order_id))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    conn.execute("UPDATE orders SET delivery_status = ? WHERE id = ?", (status, order_id))
 
+@db_task
 def get_order_details(order_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute("SELECT user_id, product_name, price FROM orders WHERE id = ?", (order_id,))
     result = cursor.fetchone()
-    conn.close()
     if result:
         return {'user_id': result[0], 'product_name': result[1], 'price': result[2]}
     return None
 
+# ------------ User Activity (Write-Behind) ------------
+# تحديثات last_activity تُجمع في الذاكرة وتُكتب دفعة واحدة (executemany في معاملة
+# واحدة) كل ACTIVITY_FLUSH_INTERVAL ثانية، بدلاً من معاملة كتابة عند كل عرض للرصيد.
+ACTIVITY_FLUSH_INTERVAL = int(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "30"))
+
+_pending_activity = {}  # user_id -> last_activity (UTC مثل CURRENT_TIMESTAMP)
+
+def touch_user(user_id):
+    _pending_activity[user_id] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+async def flush_user_activity():
+    global _pending_activity
+    if not _pending_activity:
+        return
+    pending, _pending_activity = _pending_activity, {}
+    try:
+        await save_user_activity(list(pending.items()))
+    except Exception:
+        logging.exception("Failed to flush activity for %s users", len(pending))
+        # إعادة ما لم يُكتب دون الكتابة فوق نشاط أحدث
+        for user_id, last_activity in pending.items():
+            _pending_activity.setdefault(user_id, last_activity)
+
+async def activity_flusher():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        await flush_user_activity()
+
+# ------------ Balance Ledger ------------
+# كل تغيير في الرصيد يُسجَّل في balance_ledger داخل معاملته (انظر append_ledger_entry).
+# التدقيق تزايدي: يقرأ فقط القيود بعد آخر نقطة تدقيق، ويتحقق من تسلسلها لكل مستخدم
+# (الرصيد السابق + المبلغ = balance_after) ومن مطابقة users.balance لآخر قيد.
+LEDGER_RECONCILE_INTERVAL = int(os.environ.get("LEDGER_RECONCILE_INTERVAL", "300"))
+LEDGER_RECONCILE_BATCH = int(os.environ.get("LEDGER_RECONCILE_BATCH", "5000"))
+LEDGER_TOLERANCE = 0.005  # فروق أصغر من نصف سنت تُعد أخطاء تقريب REAL
+LEDGER_MAX_REPORTED = 20
+LEDGER_ENTRY_TYPES = {
+    'opening': "رصيد افتتاحي",
+    'purchase': "شراء",
+    'refund': "استرداد إلغاء",
+    'admin_adjust': "تعديل من الأدمن",
+}
+
+@db_task
+def reconcile_ledger(batch_size=LEDGER_RECONCILE_BATCH):
+    """تدقيق دفعة من القيود الجديدة وتقديم نقاط التدقيق. يعيد (عدد القيود، قائمة الفروقات)."""
+    conn = get_connection()
+    mismatches = []
+    with transaction(conn) as cursor:
+        cursor.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM ledger_checkpoints")
+        last_checked = cursor.fetchone()[0]
+        cursor.execute("SELECT id, user_id, amount, balance_after FROM balance_ledger WHERE id > ? ORDER BY id LIMIT ?",
+                       (last_checked, batch_size))
+        entries = cursor.fetchall()
+        by_user = {}
+        for entry in entries:
+            by_user.setdefault(entry[1], []).append(entry)
+
+        for user_id, user_entries in by_user.items():
+            cursor.execute("SELECT balance FROM ledger_checkpoints WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            running = row[0] if row else 0.0
+            for entry_id, _, amount, balance_after in user_entries:
+                if abs(running + amount - balance_after) > LEDGER_TOLERANCE:
+                    mismatches.append({'user_id': user_id, 'ledger_id': entry_id,
+                                       'expected': running + amount, 'actual': balance_after})
+                running = balance_after
+            last_id = user_entries[-1][0]
+
+            # الرصيد المخزَّن يُقارن فقط إن لم تأتِ بعد هذه الدفعة قيود أحدث للمستخدم
+            cursor.execute("SELECT MAX(id) FROM balance_ledger WHERE user_id = ?", (user_id,))
+            if cursor.fetchone()[0] == last_id:
+                cursor.execute("SELECT balance FROM users WHERE id = ?", (user_id,))
+                row = cursor.fetchone()
+                cached = row[0] if row else 0.0
+                if abs(cached - running) > LEDGER_TOLERANCE:
+                    mismatches.append({'user_id': user_id, 'ledger_id': None, 'expected': running, 'actual': cached})
+
+            cursor.execute("""
+                INSERT INTO ledger_checkpoints (user_id, ledger_id, balance, checked_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    ledger_id = excluded.ledger_id, balance = excluded.balance, checked_at = excluded.checked_at
+            """, (user_id, last_id, running))
+    return len(entries), mismatches
+
+@db_task
+def audit_cached_balances(limit=LEDGER_MAX_REPORTED):
+    """مقارنة users.balance بنقاط التدقيق لكل المستخدمين (دون قراءة السجل) لكشف تعديلات خارج السجل.
+
+    المستخدمون الذين لديهم قيود لم تُدقَّق بعد يُستثنون؛ يغطيهم reconcile_ledger.
+    """
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT u.id, COALESCE(cp.balance, 0), u.balance
+        FROM users u LEFT JOIN ledger_checkpoints cp ON cp.user_id = u.id
+        WHERE ABS(u.balance - COALESCE(cp.balance, 0)) > ?
+          AND NOT EXISTS (SELECT 1 FROM balance_ledger l WHERE l.user_id = u.id AND l.id > COALESCE(cp.ledger_id, 0))
+        ORDER BY u.id LIMIT ?
+    """, (LEDGER_TOLERANCE, limit))
+    return [{'user_id': user_id, 'ledger_id': None, 'expected': expected, 'actual': actual}
+            for user_id, expected, actual in cursor.fetchall()]
+
+@db_task
+def get_ledger_entries(user_id, limit=15):
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT id, type, amount, balance_after, order_id, actor_id, created_at
+        FROM balance_ledger WHERE user_id = ? ORDER BY id DESC LIMIT ?
+    """, (user_id, limit))
+    return cursor.fetchall()
+
+def format_ledger_mismatches(mismatches):
+    lines = []
+    for m in mismatches[:LEDGER_MAX_REPORTED]:
+        where = f"القيد #{m['ledger_id']}" if m['ledger_id'] else "الرصيد المخزَّن"
+        lines.append(f"• المستخدم {m['user_id']} ({where}): المتوقع {m['expected']:.2f}، الفعلي {m['actual']:.2f}")
+    if len(mismatches) > LEDGER_MAX_REPORTED:
+        lines.append(f"… و{len(mismatches) - LEDGER_MAX_REPORTED} أخرى")
+    return "\n".join(lines)
+
+_alerted_mismatches = set()  # (user_id, ledger_id, actual) نُبِّه عنها سابقاً، حتى لا يتكرر التنبيه كل دورة
+
+async def run_ledger_reconciliation():
+    """تدقيق كل القيود المتراكمة دفعةً دفعة، ثم مراجعة الأرصدة المخزَّنة مقابل نقاط التدقيق
+    (لكشف التعديلات خارج السجل)، وتنبيه الأدمن بالفروقات الجديدة. يعيد (عدد القيود، الفروقات)."""
+    checked, mismatches = 0, []
+    while True:
+        count, batch_mismatches = await reconcile_ledger()
+        checked += count
+        mismatches.extend(batch_mismatches)
+        if count < LEDGER_RECONCILE_BATCH:
+            break
+    reported = {m['user_id'] for m in mismatches if m['ledger_id'] is None}
+    mismatches.extend(m for m in await audit_cached_balances() if m['user_id'] not in reported)
+
+    new = [m for m in mismatches if (m['user_id'], m['ledger_id'], round(m['actual'], 2)) not in _alerted_mismatches]
+    if new:
+        logging.warning("Ledger reconciliation found %s new mismatches", len(new))
+        _alerted_mismatches.update((m['user_id'], m['ledger_id'], round(m['actual'], 2)) for m in new)
+        await notify(ADMIN_ID, "⚠️ تدقيق الأرصدة: فروقات بين الرصيد والسجل:\n" + format_ledger_mismatches(new))
+    return checked, mismatches
+
+async def ledger_reconciler():
+    while True:
+        try:
+            checked, _ = await run_ledger_reconciliation()
+            if checked:
+                logging.info("Reconciled %s ledger entries", checked)
+        except Exception:
+            logging.exception("Ledger reconciliation failed")
+        await asyncio.sleep(LEDGER_RECONCILE_INTERVAL)
+
+# ------------ Notification Queue ------------
+# إشعارات الأدمن تُحفظ في جدول notifications ثم يرسلها عامل خلفي، فلا ينتظر المستخدم
+# رحلة API ثانية ولا يُفقد إشعار عند فشل الإرسال أو إعادة التشغيل. عند تراكم عدة إشعارات
+# لنفس المحادثة تُدمج في رسالة ملخص واحدة.
+NOTIFY_POLL_INTERVAL = float(os.environ.get("NOTIFY_POLL_INTERVAL", "30"))
+NOTIFY_BATCH_SIZE = int(os.environ.get("NOTIFY_BATCH_SIZE", "50"))
+NOTIFY_DIGEST_THRESHOLD = int(os.environ.get("NOTIFY_DIGEST_THRESHOLD", "5"))  # 0 لتعطيل الدمج
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", "15"))
+NOTIFY_MAX_BACKOFF = int(os.environ.get("NOTIFY_MAX_BACKOFF", "900"))
+MESSAGE_TEXT_LIMIT = 4096
+DIGEST_MAX_BUTTONS = 50
+
+_notify_wakeup = asyncio.Event()
+
+@db_task
+def insert_notification(chat_id, text, parse_mode, reply_markup):
+    now = time.time()
+    conn = get_connection()
+    conn.execute("""
+        INSERT INTO notifications (chat_id, text, parse_mode, reply_markup, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (chat_id, text, parse_mode, reply_markup, now, now))
+
+@db_task
+def get_due_notifications(now, limit):
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT id, chat_id, text, parse_mode, reply_markup, attempts FROM notifications
+        WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?
+    """, (now, limit))
+    return cursor.fetchall()
+
+@db_task
+def get_next_notification_time():
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT MIN(next_attempt_at) FROM notifications WHERE status = 'pending'")
+    return cursor.fetchone()[0]
+
+@db_task
+def delete_notifications(ids):
+    conn = get_connection()
+    conn.execute(f"DELETE FROM notifications WHERE id IN ({','.join('?' * len(ids))})", ids)
+
+@db_task
+def reschedule_notifications(ids, next_attempt_at, error=None, count_attempt=True, final=False):
+    """تأجيل الإشعارات؛ مع count_attempt تُحسب محاولة فاشلة وتُعلَّم failed بعد آخر محاولة
+    (أو فوراً مع final، لخطأ دائم لن تصلحه إعادة المحاولة)."""
+    conn = get_connection()
+    placeholders = ','.join('?' * len(ids))
+    if count_attempt:
+        conn.execute(f"""
+            UPDATE notifications SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?,
+                status = CASE WHEN ? OR attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+            WHERE id IN ({placeholders})
+        """, (next_attempt_at, error, final, NOTIFY_MAX_ATTEMPTS, *ids))
+    else:
+        conn.execute(f"UPDATE notifications SET next_attempt_at = ? WHERE id IN ({placeholders})",
+                     (next_attempt_at, *ids))
+
+def split_message_text(text, limit=MESSAGE_TEXT_LIMIT):
+    """تقسيم نص طويل إلى أجزاء لا تتجاوز حد Telegram، عند آخر سطر جديد في كل جزء إن وُجد."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+async def notify(chat_id, text, parse_mode=None, reply_markup=None):
+    """إضافة إشعار إلى الطابور (كتابة محلية سريعة) وإيقاظ العامل.
+
+    النص الأطول من MESSAGE_TEXT_LIMIT يُقسَّم إلى عدة إشعارات (الأزرار مع الجزء الأخير)،
+    فلا يبقى إشعار لا يمكن إرساله أبداً.
+    """
+    markup = json.dumps(reply_markup.to_python()) if reply_markup else None
+    parts = split_message_text(text)
+    for index, part in enumerate(parts):
+        await insert_notification(chat_id, part, parse_mode, markup if index == len(parts) - 1 else None)
+    _notify_wakeup.set()
+
+def _digest_messages(rows):
+    """دمج إشعارات محادثة واحدة في رسائل ملخص ضمن حدود طول النص وعدد الأزرار."""
+    messages = []
+    ids, parts, buttons, length = [], [], [], 0
+    separator = "\n\n— — —\n\n"
+    for notification_id, _, text, _, reply_markup, _ in rows:
+        rows_markup = json.loads(reply_markup)['inline_keyboard'] if reply_markup else []
+        extra = len(text) + len(separator)
+        if ids and (length + extra > MESSAGE_TEXT_LIMIT - 100 or len(buttons) + len(rows_markup) > DIGEST_MAX_BUTTONS):
+            messages.append((ids, parts, buttons))
+            ids, parts, buttons, length = [], [], [], 0
+        ids.append(notification_id)
+        parts.append(text)
+        buttons.extend(rows_markup)
+        length += extra
+    if ids:
+        messages.append((ids, parts, buttons))
+    return [
+        (ids, f"📬 ملخص {len(ids)} إشعارات:{separator}" + separator.join(parts) if len(ids) > 1 else parts[0],
+         {'inline_keyboard': buttons} if buttons else None)
+        for ids, parts, buttons in messages
+    ]
+
+async def deliver_due_notifications():
+    """إرسال الإشعارات المستحقة؛ يُرجع عدد الثواني حتى الجولة التالية."""
+    rows = await get_due_notifications(time.time(), NOTIFY_BATCH_SIZE)
+    if not rows:
+        next_time = await get_next_notification_time()
+        return NOTIFY_POLL_INTERVAL if next_time is None else min(NOTIFY_POLL_INTERVAL, max(0.0, next_time - time.time()))
+
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault((row[1], row[3]), []).append(row)
+    outgoing = []
+    for (chat_id, parse_mode), group in groups.items():
+        if NOTIFY_DIGEST_THRESHOLD and len(group) >= NOTIFY_DIGEST_THRESHOLD:
+            messages = _digest_messages(group)
+        else:
+            messages = [([r[0]], r[2], json.loads(r[4]) if r[4] else None) for r in group]
+        attempts = {r[0]: r[5] for r in group}
+        for ids, text, markup in messages:
+            outgoing.append((chat_id, parse_mode, ids, text, markup, max(attempts[i] for i in ids)))
+
+    for index, (chat_id, parse_mode, ids, text, markup, attempts) in enumerate(outgoing):
+        try:
+            try:
+                await bot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=markup)
+            except BadRequest as e:
+                # نص المستخدم قد يكسر تنسيق HTML/Markdown: الإرسال كنص عادي أفضل من فقدان الإشعار
+                if not parse_mode or "parse entities" not in str(e):
+                    raise
+                await bot.send_message(chat_id, text, reply_markup=markup)
+        except RetryAfter as e:
+            remaining = [i for item in outgoing[index:] for i in item[2]]
+            await reschedule_notifications(remaining, time.time() + e.timeout, count_attempt=False)
+            return e.timeout
+        except BadRequest as e:
+            # خطأ دائم (رسالة طويلة، محادثة غير موجودة...): إعادة المحاولة لن تنجح
+            logging.error("Notification %s to %s failed permanently: %s", ids, chat_id, e)
+            await reschedule_notifications(ids, time.time(), str(e), final=True)
+            continue
+        except TelegramAPIError as e:
+            delay = min(NOTIFY_MAX_BACKOFF, 5 * 2 ** attempts)
+            logging.warning("Notification %s to %s failed (attempt %s): %s", ids, chat_id, attempts + 1, e)
+            await reschedule_notifications(ids, time.time() + delay, str(e))
+            continue
+        await delete_notifications(ids)
+    return 0 if len(rows) == NOTIFY_BATCH_SIZE else NOTIFY_POLL_INTERVAL
+
+async def notification_worker():
+    while True:
+        _notify_wakeup.clear()
+        try:
+            delay = await deliver_due_notifications()
+        except Exception:
+            logging.exception("Notification delivery failed")
+            delay = NOTIFY_POLL_INTERVAL
+        if delay:
+            try:
+                await asyncio.wait_for(_notify_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+# ------------ Catalog Snapshot ------------
+class CatalogSnapshot:
+    """لقطة من الأقسام والمنتجات في الذاكرة مع نصوص ولوحات مفاتيح جاهزة للعرض.
+
+    تُبنى مرة واحدة عند التشغيل، ثم تُحدَّث جزئياً بعد كل تعديل من الأدمن
+    (إضافة/حذف منتج أو قسم)، فيُخدم تصفح المنتجات دون أي استعلام لقاعدة البيانات.
+    العرض مقسّم إلى صفحات بترقيم keyset: مؤشر الصفحة هو آخر (أصغر) ID في الصفحة
+    السابقة، وتُستخرج الصفحة بـ bisect على قائمة IDs مرتبة.
+    """
+
+    def __init__(self):
+        self.categories = {}        # cat_id -> name
+        self.products = {}          # cat_id -> {pid: (name, price)}
+        self.product_ids = {}       # cat_id -> [pid, ...] مرتبة تصاعدياً
+        self.product_category = {}  # pid -> cat_id
+        self.stock = {}             # pid -> عدد العناصر المتاحة (المنتجات بلا مخزون غير موجودة هنا)
+        self.stock_versions = {}    # pid -> إصدار آخر عدد طُبِّق (انظر next_stock_version)
+        self.stock_loaded_version = 0
+        self._categories_view = None
+        self._views = {}            # (cat_id, cursor, is_admin) -> (text, kb)
+        self._index = None          # فهرس البادئات للوضع المضمن، يُبنى عند أول استعلام بعد أي تغيير
+        self._query_cache = OrderedDict()  # نص الاستعلام -> [pid, ...]
+        self._inline_results = {}   # pid -> InlineQueryResultArticle
+
+    def load(self, conn):
+        self.categories = dict(conn.execute("SELECT id, name FROM categories ORDER BY id ASC").fetchall())
+        self.products = {cat_id: {} for cat_id in self.categories}
+        self.product_category = {}
+        for pid, name, price, cat_id in conn.execute("SELECT id, name, price, category_id FROM products"):
+            if cat_id in self.products:
+                self.products[cat_id][pid] = (name, price)
+                self.product_category[pid] = cat_id
+        self.product_ids = {cat_id: sorted(products) for cat_id, products in self.products.items()}
+        # العدّ داخل معاملة كتابة حتى يشمل كل تعديل بإصدار أقدم ولا يشمل أي تعديل بإصدار أحدث
+        with transaction(conn) as cursor:
+            self.stock = dict(cursor.execute("SELECT product_id, COUNT(*) FROM product_stock WHERE order_id IS NULL GROUP BY product_id"))
+            self.stock_versions = {}
+            self.stock_loaded_version = next_stock_version()
+        self.render_all()
+
+    @staticmethod
+    def page_size():
+        try:
+            return min(max(int(get_setting('products_page_size')), 1), 50)
+        except (TypeError, ValueError):
+            return 10
+
+    def render_all(self):
+        """إعادة رسم كل العروض (مثلاً بعد تغيير رمز العملة) دون قراءة قاعدة البيانات."""
+        self._views = {}
+        self._invalidate_index()
+        self._render_categories()
+        for cat_id in self.categories:
+            self._render_category(cat_id)
+
+    def _render_categories(self):
+        if not self.categories:
+            self._categories_view = None
+            return
+        text = "📦 *الأقسام المتاحة:*\n\nالرجاء اختيار قسم لعرض المنتجات داخله:"
+        kb = InlineKeyboardMarkup(row_width=1)
+        for cat_id, name in sorted(self.categories.items()):
+            kb.add(InlineKeyboardButton(f"📁 {name}", callback_data=f"view_products_{cat_id}"))
+        kb.add(InlineKeyboardButton("رجوع إلى القائمة الرئيسية 🏠", callback_data="user_main_menu"))
+        self._categories_view = (text, kb)
+
+    def _render_category(self, cat_id):
+        # الصفحات الأخرى تُرسم عند أول طلب لها ثم تُخزَّن؛ الصفحة الأولى جاهزة دائماً
+        for key in [key for key in self._views if key[0] == cat_id]:
+            del self._views[key]
+        for is_admin in (False, True):
+            self._views[(cat_id, 0, is_admin)] = self._build_category_view(cat_id, 0, is_admin)
+
+    def _build_category_view(self, cat_id, cursor, is_admin):
+        category_name = self.categories.get(cat_id, "قسم غير معروف")
+        products = self.products.get(cat_id)
+        currency = get_setting('currency_symbol')
+
+        if not products:
+            text = f"📦 *قسم: {category_name}*\n\nلا توجد منتجات في هذا القسم حالياً."
+            kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️ رجوع للأقسام", callback_data="show_categories"))
+            return text, kb
+
+        ids = self.product_ids[cat_id]
+        size = self.page_size()
+        end = bisect_left(ids, cursor) if cursor else len(ids)
+        page_ids = ids[max(end - size, 0):end][::-1]
+        if not page_ids:
+            return self._build_category_view(cat_id, 0, is_admin)
+
+        newer_count = len(ids) - end
+        page_number = math.ceil(newer_count / size) + 1
+        total_pages = math.ceil(len(ids) / size)
+
+        text = f"📦 *قسم: {category_name}* ({len(products)} منتج)"
+        if total_pages > 1:
+            text += f" - صفحة {page_number} من {total_pages}"
+        text += "\n\n"
+        kb = InlineKeyboardMarkup(row_width=1)
+
+        for pid in page_ids:
+            name, price = products[pid]
+            admin_info = f"(ID: {pid}) " if is_admin else ""
+            stock = self.stock.get(pid)
+            stock_info = f" | المخزون: {stock} ⚡ تسليم فوري" if stock else ""
+            text += f"• **{admin_info}{name}**\n   السعر: {price:.2f} {currency}{stock_info}\n"
+            kb.add(InlineKeyboardButton(f"{'⚡ ' if stock else ''}شراء {name} ({price:.2f} {currency})", callback_data=f"buy_{pid}"))
+
+        nav = []
+        if newer_count:
+            prev_cursor = ids[end + size] if end + size < len(ids) else 0
+            nav.append(InlineKeyboardButton("السابق ➡️", callback_data=f"view_products_{cat_id}_{prev_cursor}"))
+        if end > size:
+            nav.append(InlineKeyboardButton("⬅️ التالي", callback_data=f"view_products_{cat_id}_{page_ids[-1]}"))
+        if nav:
+            kb.row(*nav)
+
+        kb.add(InlineKeyboardButton("⬅️ رجوع للأقسام", callback_data="show_categories"))
+        kb.add(InlineKeyboardButton("القائمة الرئيسية 🏠", callback_data="user_main_menu"))
+        return text, kb
+
+    def categories_view(self):
+        return self._categories_view
+
+    # --- الوضع المضمن (inline): فهرس بادئات في الذاكرة ---
+    # قائمتان مرتبتان من (كلمة، id): كلمات أسماء المنتجات وكلمات أسماء الأقسام. كل كلمة في
+    # الاستعلام تُطابق كبادئة بـ bisect، ونتائج الكلمات تتقاطع (AND).
+    INLINE_QUERY_CACHE_SIZE = 512
+
+    @staticmethod
+    def _words(text):
+        return set(re.findall(r"\w+", text.casefold()))
+
+    def _invalidate_index(self):
+        self._index = None
+        self._query_cache.clear()
+        self._inline_results.clear()
+
+    def _build_index(self):
+        product_words = sorted((word, pid) for pid, cat_id in self.product_category.items()
+                               for word in self._words(self.products[cat_id][pid][0]))
+        category_words = sorted((word, cat_id) for cat_id, name in self.categories.items() for word in self._words(name))
+        newest_first = sorted(self.product_category, reverse=True)
+        self._index = (product_words, category_words, newest_first)
+
+    @staticmethod
+    def _prefix_matches(entries, prefix):
+        i = bisect_left(entries, (prefix,))
+        while i < len(entries) and entries[i][0].startswith(prefix):
+            yield entries[i][1]
+            i += 1
+
+    def search(self, query):
+        """IDs المنتجات المطابقة (الأحدث أولاً)؛ الاستعلام الفارغ يُرجع كل المنتجات."""
+        query = query.strip().casefold()
+        cached = self._query_cache.get(query)
+        if cached is not None:
+            self._query_cache.move_to_end(query)
+            return cached
+
+        if self._index is None:
+            self._build_index()
+        product_words, category_words, newest_first = self._index
+        terms = re.findall(r"\w+", query)[:SEARCH_MAX_TERMS]
+        if not terms:
+            result = newest_first
+        else:
+            matched = None
+            for term in terms:
+                ids = set(self._prefix_matches(product_words, term))
+                for cat_id in self._prefix_matches(category_words, term):
+                    ids.update(self.products.get(cat_id, ()))
+                matched = ids if matched is None else matched & ids
+                if not matched:
+                    break
+            result = sorted(matched, reverse=True)
+
+        self._query_cache[query] = result
+        if len(self._query_cache) > self.INLINE_QUERY_CACHE_SIZE:
+            self._query_cache.popitem(last=False)
+        return result
+
+    def product_card(self, pid):
+        """بطاقة منتج واحد (نص HTML) أو None إن لم يعد معروضاً."""
+        cat_id = self.product_category.get(pid)
+        if cat_id is None:
+            return None
+        name, price = self.products[cat_id][pid]
+        stock = self.stock.get(pid)
+        text = (f"🛍️ <b>{html.escape(name)}</b>\n"
+                f"📁 القسم: {html.escape(self.categories[cat_id])}\n"
+                f"💰 السعر: {price:.2f} {get_setting('currency_symbol')}")
+        if stock:
+            text += f"\n⚡ تسليم فوري (المخزون: {stock})"
+        return text
+
+    def inline_result(self, pid, bot_username):
+        result = self._inline_results.get(pid)
+        if result is None:
+            cat_id = self.product_category[pid]
+            name, price = self.products[cat_id][pid]
+            stock = self.stock.get(pid)
+            description = f"{price:.2f} {get_setting('currency_symbol')} • {self.categories[cat_id]}"
+            if stock:
+                description += f" • ⚡ متوفر ({stock})"
+            result = types.InlineQueryResultArticle(
+                id=str(pid),
+                title=name,
+                description=description,
+                input_message_content=types.InputTextMessageContent(self.product_card(pid), parse_mode="HTML"),
+                reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton(
+                    "🛒 شراء من المتجر", url=f"https://t.me/{bot_username}?start=product_{pid}")),
+            )
+            self._inline_results[pid] = result
+        return result
+
+    def category_view(self, cat_id, cursor=0, is_admin=False):
+        key = (cat_id, cursor, is_admin)
+        view = self._views.get(key)
+        if view is None:
+            view = self._build_category_view(cat_id, cursor, is_admin)
+            if cat_id in self.categories:
+                self._views[key] = view
+        return view
+
+    # --- تحديثات جزئية بعد تعديلات الأدمن ---
+    def add_product(self, pid, name, price, cat_id):
+        if cat_id not in self.categories:
+            return
+        self.products[cat_id][pid] = (name, price)
+        insort(self.product_ids[cat_id], pid)
+        self.product_category[pid] = cat_id
+        self._invalidate_index()
+        self._render_category(cat_id)
+
+    def set_stock(self, pid, count):
+        if self.stock.get(pid, 0) == count:
+            return
+        if count:
+            self.stock[pid] = count
+        else:
+            self.stock.pop(pid, None)
+        self._inline_results.pop(pid, None)
+        cat_id = self.product_category.get(pid)
+        if cat_id is not None:
+            self._render_category(cat_id)
+
+    def update_stock(self, pid, count, version):
+        """تطبيق عدد قرأته معاملة شراء أو إضافة مخزون، إلا إن كان لدى اللقطة عدد أحدث منه:
+        المعاملات المتزامنة قد تنتهي معالجاتها بغير ترتيب تثبيتها."""
+        if version <= max(self.stock_versions.get(pid, 0), self.stock_loaded_version):
+            return
+        self.stock_versions[pid] = version
+        self.set_stock(pid, count)
+
+    def remove_product(self, pid):
+        self.stock.pop(pid, None)
+        self.stock_versions.pop(pid, None)
+        cat_id = self.product_category.pop(pid, None)
+        if cat_id is None:
+            return
+        self.products[cat_id].pop(pid, None)
+        self.product_ids[cat_id].remove(pid)
+        self._invalidate_index()
+        self._render_category(cat_id)
+
+    def add_category(self, cat_id, name):
+        self.categories[cat_id] = name
+        self.products[cat_id] = {}
+        self.product_ids[cat_id] = []
+        self._invalidate_index()
+        self._render_categories()
+        self._render_category(cat_id)
+
+    def remove_category(self, cat_id):
+        # المنتجات المرتبطة تصبح "بدون قسم" ولا تظهر في التصفح
+        self.categories.pop(cat_id, None)
+        for pid in self.products.pop(cat_id, {}):
+            self.product_category.pop(pid, None)
+        self.product_ids.pop(cat_id, None)
+        for key in [key for key in self._views if key[0] == cat_id]:
+            del self._views[key]
+        self._invalidate_index()
+        self._render_categories()
+
+catalog = CatalogSnapshot()
+
+@db_task
+def build_catalog_snapshot():
+    snapshot = CatalogSnapshot()
+    snapshot.load(get_connection())
+    return snapshot
+
+async def reload_catalog():
+    """إعادة بناء اللقطة كاملة (بعد تعديلات جماعية) ثم استبدالها دفعة واحدة."""
+    global catalog
+    catalog = await build_catalog_snapshot()
+
 # ------------ States ------------
 class AddProduct(StatesGroup):
     waiting_for_category = State() 
@@ -368,6 +2115,12 @@ class EditSettings(StatesGroup):
     waiting_for_key_selection = State()
     waiting_for_new_value = State()
 
+class AdminOrderLookup(StatesGroup):
+    waiting_for_user_id = State()
+
+class SearchFlow(StatesGroup):
+    waiting_for_query = State()
+
 class SuggestionFlow(StatesGroup):
     waiting_for_suggestion = State()
 
@@ -381,6 +2134,13 @@ class SendToUserFlow(StatesGroup):
 class DeliveryFlow(StatesGroup):
     waiting_for_delivery_data = State()
 
+class ImportCatalog(StatesGroup):
+    waiting_for_file = State()
+
+class AddStock(StatesGroup):
+    waiting_for_product_id = State()
+    waiting_for_items = State()
+
 class AddCategory(StatesGroup): 
     waiting_for_name = State()
 
@@ -396,48 +2156,99 @@ class DeleteCustomButton(StatesGroup):
 
 # ------------ Keyboards and Handlers ------------
 
+# القوائم الرئيسية تُبنى مرة واحدة كصفوف ثابتة (tuples)، وكل عرض ينسخها فقط.
+# قسم الأزرار المخصصة مخزَّن ويُحدَّث عند إضافة/حذف زر، وحالة "لديه طلب قابل
+# للإلغاء" محفوظة في الذاكرة لكل مستخدم، فلا يحتاج عرض القائمة أي استعلام.
+def _frozen_rows(kb):
+    return tuple(tuple(row) for row in kb.inline_keyboard)
+
+_USER_MENU_ROWS = _frozen_rows(InlineKeyboardMarkup(row_width=2).add(
+    InlineKeyboardButton("الملف الشخصي 👤", callback_data="my_profile"),
+    InlineKeyboardButton("إيداع 💸", callback_data="start_deposit"),
+    InlineKeyboardButton("عرض المنتجات 🛍️", callback_data="show_categories"), 
+    InlineKeyboardButton("بحث عن منتج 🔍", callback_data="search_products"),
+    InlineKeyboardButton("سجل الطلبات 📜", callback_data="order_history"),
+    InlineKeyboardButton("إرسال اقتراح 💡", callback_data="send_suggestion"),
+    InlineKeyboardButton("الأسئلة الشائعة ❓", callback_data="show_faq")
+))
+
+_ADMIN_MENU_ROWS = _frozen_rows(InlineKeyboardMarkup(row_width=2).add(
+    InlineKeyboardButton("📊 الإحصائيات", callback_data="show_statistics"), 
+    InlineKeyboardButton("➕ إدارة المنتجات ➖", callback_data="manage_products"),
+    InlineKeyboardButton("📁 إدارة الأقسام", callback_data="manage_categories"), 
+    InlineKeyboardButton("🔗 إدارة الأزرار المخصصة", callback_data="manage_custom_buttons"), 
+    InlineKeyboardButton("💰 إدارة الرصيد", callback_data="manage_balance"),
+    InlineKeyboardButton("⚙️ إعدادات البوت", callback_data="edit_settings"),
+    InlineKeyboardButton("📢 إرسال رسالة جماعية", callback_data="start_broadcast"),
+    InlineKeyboardButton("✉️ إرسال رسالة لفرد", callback_data="start_send_to_user"),
+    InlineKeyboardButton("🔎 سجل طلبات مستخدم", callback_data="lookup_user_orders"),
+    InlineKeyboardButton("📤 تصدير الطلبات", callback_data="export_orders")
+).add(
+    InlineKeyboardButton("📦 عرض المنتجات", callback_data="show_categories")
+).add(
+    InlineKeyboardButton("رجوع إلى القائمة الرئيسية (المستخدم) 🏠", callback_data="user_main_menu")
+))
+
+_custom_button_rows = ()
+_pending_cancellations = {}  # user_id -> (order_id, expiry_time)
+
+def set_custom_buttons(buttons):
+    global _custom_button_rows
+    _custom_button_rows = tuple((InlineKeyboardButton(text, url=url),) for _, text, url in buttons)
+
+async def refresh_custom_buttons():
+    set_custom_buttons(await get_custom_buttons())
+
+def remember_cancellable_order(user_id, order_id, expiry_time):
+    _pending_cancellations[user_id] = (order_id, expiry_time)
+
+def forget_cancellable_order(user_id, order_id=None):
+    pending = _pending_cancellations.get(user_id)
+    if pending and (order_id is None or pending[0] == order_id):
+        del _pending_cancellations[user_id]
+
+def get_pending_cancellation(user_id):
+    pending = _pending_cancellations.get(user_id)
+    if not pending:
+        return None
+    order_id, expiry_time = pending
+    if expiry_time <= datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
+        del _pending_cancellations[user_id]
+        return None
+    return order_id
+
+def prune_pending_cancellations(now):
+    for user_id in [user_id for user_id, (_, expiry_time) in _pending_cancellations.items() if expiry_time <= now]:
+        del _pending_cancellations[user_id]
+
+def load_menu_cache(conn):
+    set_custom_buttons(conn.execute("SELECT id, text, url FROM custom_buttons ORDER BY id ASC").fetchall())
+    _pending_cancellations.clear()
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = conn.execute("SELECT user_id, order_id, expiry_time FROM cancellable_orders WHERE expiry_time > ? ORDER BY order_id ASC", (now,))
+    for user_id, order_id, expiry_time in rows:
+        remember_cancellable_order(user_id, order_id, expiry_time)
+
 def user_menu(user_id):
-    kb = InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        InlineKeyboardButton("الملف الشخصي 👤", callback_data="my_profile"),
-        InlineKeyboardButton("إيداع 💸", callback_data="start_deposit"),
-        InlineKeyboardButton("عرض المنتجات 🛍️", callback_data="show_categories"), 
-        InlineKeyboardButton("سجل الطلبات 📜", callback_data="order_history"),
-        InlineKeyboardButton("إرسال اقتراح 💡", callback_data="send_suggestion"),
-        InlineKeyboardButton("الأسئلة الشائعة ❓", callback_data="show_faq")
-    )
-    
-    custom_buttons = get_custom_buttons()
-    for _, text, url in custom_buttons:
-        kb.add(InlineKeyboardButton(text, url=url))
+    rows = [list(row) for row in _USER_MENU_ROWS + _custom_button_rows]
 
-    pending_order = get_cancellable_order(user_id)
-    if pending_order:
-         kb.add(InlineKeyboardButton("إلغاء آخر طلب ❌", callback_data=f"cancel_{pending_order[0]}"))
+    pending_order_id = get_pending_cancellation(user_id)
+    if pending_order_id:
+        rows.append([InlineKeyboardButton("إلغاء آخر طلب ❌", callback_data=f"cancel_{pending_order_id}")])
 
-    return kb
+    return InlineKeyboardMarkup(row_width=2, inline_keyboard=rows)
 
 def admin_menu():
-    kb = InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        InlineKeyboardButton("📊 الإحصائيات", callback_data="show_statistics"), 
-        InlineKeyboardButton("➕ إدارة المنتجات ➖", callback_data="manage_products"),
-        InlineKeyboardButton("📁 إدارة الأقسام", callback_data="manage_categories"), 
-        InlineKeyboardButton("🔗 إدارة الأزرار المخصصة", callback_data="manage_custom_buttons"), 
-        InlineKeyboardButton("💰 إدارة الرصيد", callback_data="manage_balance"),
-        InlineKeyboardButton("⚙️ إعدادات البوت", callback_data="edit_settings"),
-        InlineKeyboardButton("📢 إرسال رسالة جماعية", callback_data="start_broadcast"),
-        InlineKeyboardButton("✉️ إرسال رسالة لفرد", callback_data="start_send_to_user")
-    )
-    kb.add(InlineKeyboardButton("📦 عرض المنتجات", callback_data="show_categories"))
-    kb.add(InlineKeyboardButton("رجوع إلى القائمة الرئيسية (المستخدم) 🏠", callback_data="user_main_menu"))
-    return kb
+    return InlineKeyboardMarkup(row_width=2, inline_keyboard=[list(row) for row in _ADMIN_MENU_ROWS])
 
 def manage_products_menu():
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
         InlineKeyboardButton("➕ إضافة منتج", callback_data="add_product"),
         InlineKeyboardButton("➖ حذف منتج", callback_data="delete_product"),
+        InlineKeyboardButton("📥 إضافة مخزون", callback_data="add_stock"),
+        InlineKeyboardButton("📂 استيراد منتجات", callback_data="import_catalog"),
+        InlineKeyboardButton("💾 تصدير الكتالوج", callback_data="export_catalog"),
         InlineKeyboardButton("رجوع إلى قائمة الأدمن ⬅️", callback_data="admin_main_menu")
     )
     return kb
@@ -478,7 +2289,9 @@ def settings_list_menu():
         'admin_welcome_message': "رسالة ترحيب الأدمن",
         'cancellation_time_minutes': "مهلة الإلغاء (دقيقة)",
         'faq_text': "نص الأسئلة الشائعة",
-        'suggestion_thanks': "رسالة شكر الاقتراحات"
+        'suggestion_thanks': "رسالة شكر الاقتراحات",
+        'products_page_size': "عدد المنتجات في الصفحة",
+        'low_stock_threshold': "حد تنبيه نقص المخزون"
     }
     for key, name in settings_keys.items():
         kb.add(InlineKeyboardButton(f"⚙️ {name}", callback_data=f"edit_key_{key}"))
@@ -492,7 +2305,7 @@ def back_button_user():
 @dp.message_handler(commands=['start', 'menu'], state="*")
 async def start_handler(msg: types.Message, state: FSMContext):
     await state.finish()
-    get_user_balance(msg.from_user.id) 
+    touch_user(msg.from_user.id)
 
     if msg.from_user.id == ADMIN_ID:
         welcome_msg = get_setting('admin_welcome_message')
@@ -501,7 +2314,20 @@ async def start_handler(msg: types.Message, state: FSMContext):
         welcome_msg = get_setting('welcome_message')
         await msg.answer(welcome_msg, reply_markup=user_menu(msg.from_user.id))
 
-@dp.callback_query_handler(lambda c: c.data == "user_main_menu", state="*")
+    # رابط عميق من نتيجة مضمنة: /start product_<pid>
+    args = msg.get_args() or ""
+    if args.startswith("product_") and args[len("product_"):].isdigit():
+        pid = int(args[len("product_"):])
+        card = catalog.product_card(pid)
+        if card:
+            price = catalog.products[catalog.product_category[pid]][pid][1]
+            kb = InlineKeyboardMarkup(row_width=1).add(
+                InlineKeyboardButton(f"شراء ({price:.2f} {get_setting('currency_symbol')})", callback_data=f"buy_{pid}"),
+                InlineKeyboardButton("⬅️ عرض القسم", callback_data=f"view_products_{catalog.product_category[pid]}"),
+            )
+            await msg.answer(card, parse_mode="HTML", reply_markup=kb)
+
+@callbacks.exact("user_main_menu", state="*")
 async def return_to_user_menu(cb: types.CallbackQuery, state: FSMContext):
     await state.finish()
     
@@ -513,7 +2339,7 @@ async def return_to_user_menu(cb: types.CallbackQuery, state: FSMContext):
         await cb.message.edit_text(welcome_msg, reply_markup=user_menu(cb.from_user.id))
     await cb.answer()
     
-@dp.callback_query_handler(lambda c: c.data == "admin_main_menu", state="*")
+@callbacks.exact("admin_main_menu", state="*")
 async def return_to_admin_menu(cb: types.CallbackQuery, state: FSMContext):
     await state.finish()
     welcome_msg = get_setting('admin_welcome_message')
@@ -521,10 +2347,11 @@ async def return_to_admin_menu(cb: types.CallbackQuery, state: FSMContext):
     await cb.answer()
 
 # ------------ User Features: Profile, FAQ, Suggestion, History ------------
-@dp.callback_query_handler(lambda c: c.data == "my_profile")
+@callbacks.exact("my_profile")
 async def show_profile(cb: types.CallbackQuery):
     user_id = cb.from_user.id
-    balance = get_user_balance(user_id)
+    touch_user(user_id)
+    balance = await get_user_balance(user_id)
     currency = get_setting('currency_symbol')
     
     text = (
@@ -535,13 +2362,13 @@ async def show_profile(cb: types.CallbackQuery):
     await cb.message.edit_text(text, parse_mode="Markdown", reply_markup=back_button_user())
     await cb.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "show_faq")
+@callbacks.exact("show_faq")
 async def show_faq(cb: types.CallbackQuery):
     faq_text = get_setting('faq_text')
     await cb.message.edit_text(f"❓ *الأسئلة الشائعة:*\n\n{faq_text}", parse_mode="Markdown", reply_markup=back_button_user())
     await cb.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "send_suggestion")
+@callbacks.exact("send_suggestion")
 async def start_suggestion(cb: types.CallbackQuery):
     await cb.message.edit_text("💡 *إرسال اقتراح:*\n\nالرجاء كتابة اقتراحك الآن:", parse_mode="Markdown", reply_markup=back_button_user())
     await SuggestionFlow.waiting_for_suggestion.set()
@@ -551,7 +2378,7 @@ async def start_suggestion(cb: types.CallbackQuery):
 async def process_suggestion(msg: types.Message, state: FSMContext):
     user_link = f"<a href='tg://user?id={msg.from_user.id}'>{msg.from_user.full_name}</a>"
     
-    await bot.send_message(
+    await notify(
         ADMIN_ID,
         f"💡 *اقتراح جديد من:*\n"
         f"👤 المستخدم: {user_link} (`{msg.from_user.id}`)\n"
@@ -563,23 +2390,74 @@ async def process_suggestion(msg: types.Message, state: FSMContext):
     await msg.answer(f"✅ {thanks_msg}", reply_markup=back_button_user())
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data == "order_history")
-async def show_order_history(cb: types.CallbackQuery):
-    orders = get_user_orders(cb.from_user.id)
+ORDER_HISTORY_PAGE_SIZE = 10
+# فلتر -> (status، delivery_status، التسمية)
+ORDER_HISTORY_FILTERS = {
+    'all': (None, None, "الكل"),
+    'pending': ('Completed', 'Pending', "قيد التسليم"),
+    'delivered': (None, 'Delivered', "مُسلَّم"),
+    'cancelled': ('Cancelled', None, "ملغى"),
+}
+
+async def render_order_history(user_id, filter_key='all', before_id=0, for_admin=False):
+    """صفحة سجل الطلبات (HTML). للأدمن تُضاف أزرار تسليم للطلبات المعلقة ورجوع لقائمته."""
+    if filter_key not in ORDER_HISTORY_FILTERS:
+        filter_key = 'all'
+    status, delivery_status, label = ORDER_HISTORY_FILTERS[filter_key]
+    orders = await get_user_orders_page(user_id, before_id or None, status, delivery_status, ORDER_HISTORY_PAGE_SIZE + 1)
+    has_older = len(orders) > ORDER_HISTORY_PAGE_SIZE
+    orders = orders[:ORDER_HISTORY_PAGE_SIZE]
     currency = get_setting('currency_symbol')
-    
-    text = "📜 *سجل آخر 10 طلبات:*\n\n"
+    # زر الصفحة: history_<filter>_<before> للمستخدم، ahistory_<user>_<filter>_<before> للأدمن
+    prefix = f"ahistory_{user_id}_" if for_admin else "history_"
+
+    title = f"سجل طلبات المستخدم <code>{user_id}</code>" if for_admin else "سجل الطلبات"
+    text = f"📜 <b>{title}</b> ({label})"
+    if before_id:
+        text += " - طلبات أقدم"
+    text += ":\n\n"
+    kb = InlineKeyboardMarkup(row_width=2)
     if orders:
-        for name, price, date, status, delivery in orders:
-            text += f"• **{name}**\n   السعر: {price:.2f} {currency} | الحالة: {status}\n   التسليم: {delivery} | التاريخ: {date[:16]}\n"
+        for order_id, name, price, date, order_status, delivery in orders:
+            text += (f"• <b>#{order_id} {html.escape(name)}</b>\n"
+                     f"   السعر: {price:.2f} {currency} | الحالة: {order_status}\n"
+                     f"   التسليم: {delivery} | التاريخ: {date[:16]}\n")
+            if for_admin and order_status == 'Completed' and delivery == 'Pending':
+                kb.insert(InlineKeyboardButton(f"📦 تسليم #{order_id}", callback_data=f"deliver_{order_id}"))
     else:
-        text += "لا يوجد لديك سجل طلبات حالياً."
-        
-    await cb.message.edit_text(text, parse_mode="Markdown", reply_markup=back_button_user())
+        text += "لا توجد طلبات في هذا السجل." if before_id else "لا يوجد سجل طلبات حالياً."
+
+    kb.row(*[
+        InlineKeyboardButton(("✅ " if key == filter_key else "") + name, callback_data=f"{prefix}{key}_0")
+        for key, (_, _, name) in ORDER_HISTORY_FILTERS.items()
+    ])
+    nav = []
+    if before_id:
+        nav.append(InlineKeyboardButton("🔝 الأحدث", callback_data=f"{prefix}{filter_key}_0"))
+    if has_older:
+        nav.append(InlineKeyboardButton("⬅️ الأقدم", callback_data=f"{prefix}{filter_key}_{orders[-1][0]}"))
+    if nav:
+        kb.row(*nav)
+    if for_admin:
+        kb.row(InlineKeyboardButton("رجوع إلى قائمة الأدمن ⬅️", callback_data="admin_main_menu"))
+    else:
+        kb.row(InlineKeyboardButton("رجوع إلى القائمة الرئيسية 🏠", callback_data="user_main_menu"))
+    return text, kb
+
+@callbacks.exact("order_history")
+async def show_order_history(cb: types.CallbackQuery):
+    text, kb = await render_order_history(cb.from_user.id)
+    await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await cb.answer()
+
+@callbacks.prefix("history_", str, int)
+async def page_order_history(cb: types.CallbackQuery, filter_key: str, before_id: int):
+    text, kb = await render_order_history(cb.from_user.id, filter_key, before_id)
+    await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
     await cb.answer()
 
 # ------------ User Features: Deposit (مع إخلاء المسؤولية) ------------
-@dp.callback_query_handler(lambda c: c.data == "start_deposit")
+@callbacks.exact("start_deposit")
 async def start_deposit(cb: types.CallbackQuery):
     await cb.message.edit_text(
         "يرجى اختيار العملة التي تريد الإيداع بها:",
@@ -587,7 +2465,7 @@ async def start_deposit(cb: types.CallbackQuery):
     )
     await cb.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "deposit_btc")
+@callbacks.exact("deposit_btc")
 async def deposit_btc(cb: types.CallbackQuery):
     await cb.message.edit_text(
         "💰 *الإيداع عبر البيتكوين (BTC):*\n\n"
@@ -633,13 +2511,13 @@ async def get_deposit_amount(msg: types.Message, state: FSMContext):
     await msg.answer(text, parse_mode="Markdown", reply_markup=kb)
     await DepositFlow.waiting_for_confirmation.set()
 
-@dp.callback_query_handler(lambda c: c.data == "confirm_btc_transfer", state=DepositFlow.waiting_for_confirmation)
+@callbacks.exact("confirm_btc_transfer", state=DepositFlow.waiting_for_confirmation)
 async def confirm_btc_transfer(cb: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     expected_amount = data.get('expected_btc_amount', 'غير محدد')
     user_link = f"<a href='tg://user?id={cb.from_user.id}'>{cb.from_user.full_name}</a>"
 
-    await bot.send_message(
+    await notify(
         ADMIN_ID,
         f"❗️ *تأكيد إيداع جديد (مراجعة يدوية):*\n\n"
         f"👤 المستخدم: {user_link}\n"
@@ -658,11 +2536,11 @@ async def confirm_btc_transfer(cb: types.CallbackQuery, state: FSMContext):
     await cb.answer()
 
 # ------------ Admin: Statistics (الإحصائيات) ------------
-@dp.callback_query_handler(lambda c: c.data == "show_statistics")
+@callbacks.exact("show_statistics")
 async def show_statistics(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     
-    stats = get_statistics()
+    stats = await get_statistics()
     currency = get_setting('currency_symbol')
     
     text = (
@@ -672,46 +2550,197 @@ async def show_statistics(cb: types.CallbackQuery):
         f"📜 إجمالي الطلبات المكتملة: *{stats['orders']}*\n"
         f"💰 إجمالي الإيرادات (المبيعات): *{stats['revenue']:.2f} {currency}*"
     )
+
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    today_stats = next((d for d in stats['daily'] if d['day'] == today), None)
+    week_orders = sum(d['orders'] for d in stats['daily'])
+    week_revenue = sum(d['revenue'] for d in stats['daily'])
+
+    text += (
+        f"\n\n📅 *اليوم:* {today_stats['orders'] if today_stats else 0} طلب | "
+        f"{today_stats['revenue'] if today_stats else 0:.2f} {currency}\n"
+        f"🗓 *آخر 7 أيام:* {week_orders} طلب | {week_revenue:.2f} {currency}\n"
+    )
+    for d in stats['daily']:
+        text += f"   • {d['day']}: {d['orders']} طلب | {d['revenue']:.2f} {currency} | ملغى: {d['cancelled']} | مُسلَّم: {d['delivered']}\n"
     
     await cb.message.edit_text(text, parse_mode="Markdown", reply_markup=admin_menu())
     await cb.answer()
 
+@dp.message_handler(commands=['metrics'], state="*")
+async def show_metrics(msg: types.Message):
+    if msg.from_user.id != ADMIN_ID: return
+    await msg.answer(metrics_summary())
+
 # ------------ Admin: Messaging Features (تم الإصلاح) ------------
 
-@dp.callback_query_handler(lambda c: c.data == "start_broadcast")
+@callbacks.exact("start_broadcast")
 async def start_broadcast(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     await cb.message.answer("📢 *البث الجماعي:*\n\nالرجاء إرسال الرسالة التي تريد إرسالها لجميع المستخدمين.", parse_mode="Markdown", reply_markup=admin_menu())
     await BroadcastFlow.waiting_for_message.set()
     await cb.answer()
 
+# محرك البث: مهمة خلفية بعدة عمّال يتشاركون دلو رموز (Token Bucket) يحدد معدل
+# الإرسال، مع احترام RetryAfter وحفظ التقدم كل BROADCAST_SAVE_EVERY رسالة لاستئنافه بعد
+# إعادة التشغيل (لا يُعاد الإرسال بعدها إلا لمن كانت رسائلهم قيد الإرسال لحظة التوقف).
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))  # رسالة/ثانية
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "8"))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "500"))
+BROADCAST_SAVE_EVERY = int(os.environ.get("BROADCAST_SAVE_EVERY", "25"))
+BROADCAST_MAX_RETRIES = 5
+
+class TokenBucket:
+    """دلو رموز بسيط: acquire ينتظر حتى يتوفر رمز، وpause يوقف الجميع (RetryAfter)."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # سعة أقل من رمز كامل (مثل BROADCAST_RATE=0.5) تجعل acquire ينتظر إلى الأبد
+        self.capacity = max(1.0, capacity or rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+async def _send_broadcast_copy(bucket, user_id, from_chat_id, message_id):
+    for _ in range(BROADCAST_MAX_RETRIES):
+        await bucket.acquire()
+        try:
+            await bot.copy_message(user_id, from_chat_id, message_id)
+            return True
+        except RetryAfter as e:
+            logging.warning("Broadcast hit flood limit, pausing for %s seconds", e.timeout)
+            bucket.pause(e.timeout)
+        except TelegramAPIError:
+            # المستخدم حظر البوت أو حذف حسابه...
+            return False
+        except Exception:
+            logging.exception("Unexpected error while broadcasting to %s", user_id)
+            return False
+    return False
+
+class BroadcastProgress:
+    """مؤشر استئناف البث: العمّال ينهون بغير ترتيب، فالمؤشر المحفوظ هو آخر مستخدم اكتمل
+    كل من قبله في الدفعة، ومعه عدد الناجح/الفاشل لهؤلاء فقط (فلا يُحسب مستخدم مرتين عند الاستئناف)."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.targets = []
+        self.results = []      # None: قيد الإرسال، True/False: نجح/فشل
+        self.position = 0      # كل ما قبله مكتمل ومحفوظ
+        self.sent = self.failed = 0
+        self._since_save = 0
+        self._lock = asyncio.Lock()
+
+    def start_batch(self, targets):
+        self.targets, self.results, self.position = targets, [None] * len(targets), 0
+        return iter(enumerate(targets))
+
+    async def mark(self, index, ok):
+        self.results[index] = ok
+        self._since_save += 1
+        if self._since_save >= BROADCAST_SAVE_EVERY:
+            await self.save()
+
+    async def save(self, last_user_id=None):
+        """حفظ المؤشر حتى أول مستخدم غير مكتمل، أو حتى last_user_id عند اكتمال الدفعة."""
+        async with self._lock:
+            self._since_save = 0
+            start, sent = self.position, 0
+            while self.position < len(self.results) and self.results[self.position] is not None:
+                sent += self.results[self.position]
+                self.position += 1
+            failed = self.position - start - sent
+            if last_user_id is None:
+                if self.position == start:
+                    return
+                last_user_id = self.targets[self.position - 1]
+            await save_broadcast_progress(self.job_id, last_user_id, sent, failed)
+            self.sent += sent
+            self.failed += failed
+
+async def _broadcast_worker(targets, progress, bucket, from_chat_id, message_id):
+    for index, user_id in targets:
+        await progress.mark(index, await _send_broadcast_copy(bucket, user_id, from_chat_id, message_id))
+
+async def _report_broadcast_progress(job, sent, failed, done=False):
+    if not job['progress_message_id']:
+        return
+    title = "✅ *اكتمل البث الجماعي:*" if done else "⏳ *جارٍ إرسال الرسائل...*"
+    try:
+        await bot.edit_message_text(
+            f"{title}\n"
+            f"تمت المعالجة: {sent + failed} من {job['total_users']}\n"
+            f"تم الإرسال بنجاح إلى: {sent}\n"
+            f"فشل الإرسال إلى: {failed}",
+            job['progress_chat_id'], job['progress_message_id'],
+            parse_mode="Markdown"
+        )
+    except TelegramAPIError:
+        pass
+
+async def run_broadcast(job_id):
+    """تنفيذ (أو استئناف) مهمة بث محفوظة حتى نهايتها."""
+    job = await get_broadcast_job(job_id)
+    if not job or job['status'] != 'Running':
+        return
+
+    bucket = TokenBucket(BROADCAST_RATE)
+    progress = BroadcastProgress(job_id)
+    last_user_id = job['last_user_id']
+
+    while True:
+        user_ids = await get_user_ids_after(last_user_id, BROADCAST_BATCH_SIZE)
+        if not user_ids:
+            break
+        # مكرر مشترك: كل عامل يسحب المستخدم التالي منه
+        targets = progress.start_batch([uid for uid in user_ids if uid != ADMIN_ID])
+        await asyncio.gather(*[
+            _broadcast_worker(targets, progress, bucket, job['from_chat_id'], job['message_id'])
+            for _ in range(BROADCAST_WORKERS)
+        ])
+        last_user_id = user_ids[-1]
+        await progress.save(last_user_id)
+        await _report_broadcast_progress(job, job['sent_count'] + progress.sent, job['failed_count'] + progress.failed)
+
+    sent, failed = job['sent_count'] + progress.sent, job['failed_count'] + progress.failed
+    await finish_broadcast_job(job_id)
+    await _report_broadcast_progress(job, sent, failed, done=True)
+    logging.info("Broadcast %s finished: %s sent, %s failed", job_id, sent, failed)
+
+async def resume_broadcasts():
+    for job_id in await get_running_broadcast_jobs():
+        logging.info("Resuming broadcast %s", job_id)
+        start_background_task(run_broadcast(job_id))
+
 @dp.message_handler(state=BroadcastFlow.waiting_for_message, content_types=types.ContentType.ANY)
 async def send_broadcast(msg: types.Message, state: FSMContext):
     if msg.from_user.id != ADMIN_ID: return
     await state.finish()
 
-    user_ids = get_all_user_ids()
-    sent_count = 0
-    failed_count = 0
-    
-    await msg.answer("⏳ جارٍ إرسال الرسائل...", reply_markup=admin_menu())
+    job_id = await create_broadcast_job(msg.chat.id, msg.message_id)
+    progress = await msg.answer("⏳ *جارٍ إرسال الرسائل...*", parse_mode="Markdown")
+    await set_broadcast_progress_message(job_id, progress.chat.id, progress.message_id)
+    start_background_task(run_broadcast(job_id))
 
-    for user_id in user_ids:
-        if user_id == ADMIN_ID: continue
-        try:
-            await bot.copy_message(user_id, msg.chat.id, msg.message_id)
-            sent_count += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            failed_count += 1
-
-    await bot.send_message(ADMIN_ID, 
-                           f"✅ *اكتمل البث الجماعي:*\n"
-                           f"تم الإرسال بنجاح إلى: {sent_count}\n"
-                           f"فشل الإرسال إلى: {failed_count}",
-                           parse_mode="Markdown")
-
-@dp.callback_query_handler(lambda c: c.data == "start_send_to_user")
+    await msg.answer("📢 بدأ البث في الخلفية، وسيتم تحديث التقدم في الرسالة أعلاه.", reply_markup=admin_menu())
+
+@callbacks.exact("start_send_to_user")
 async def start_send_to_user(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     await cb.message.answer("✉️ *إرسال رسالة فردية:*\n\nالرجاء إرسال *ID المستخدم* المستهدف.", parse_mode="Markdown", reply_markup=admin_menu())
@@ -745,16 +2774,15 @@ async def send_message_to_user(msg: types.Message, state: FSMContext):
 
 # ------------ Admin: Settings Management (تم الإصلاح) ------------
 
-@dp.callback_query_handler(lambda c: c.data == "edit_settings")
+@callbacks.exact("edit_settings")
 async def start_edit_settings(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     await cb.message.edit_text("⚙️ *إدارة إعدادات البوت:*\n\nالرجاء اختيار الإعداد الذي تريد تعديله:", parse_mode="Markdown", reply_markup=settings_list_menu())
     await cb.answer()
     
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_key_"))
-async def edit_setting_key(cb: types.CallbackQuery, state: FSMContext):
+@callbacks.prefix("edit_key_", str)
+async def edit_setting_key(cb: types.CallbackQuery, key: str, state: FSMContext):
     if cb.from_user.id != ADMIN_ID: return
-    key = cb.data.split('_')[2]
     current_value = get_setting(key)
     
     await state.update_data(setting_key=key)
@@ -773,7 +2801,9 @@ async def process_setting_value(msg: types.Message, state: FSMContext):
     key = data.get('setting_key')
     new_value = msg.text
     
-    set_setting(key, new_value)
+    await set_setting(key, new_value)
+    if key in ('currency_symbol', 'products_page_size'):
+        catalog.render_all()
     
     await state.finish()
     await msg.answer(f"✅ تم تحديث الإعداد *{key}* إلى القيمة الجديدة بنجاح:\n`{new_value}`", 
@@ -783,11 +2813,11 @@ async def process_setting_value(msg: types.Message, state: FSMContext):
 
 # ------------ Admin: Category Management ------------
 
-@dp.callback_query_handler(lambda c: c.data == "manage_categories")
+@callbacks.exact("manage_categories")
 async def show_manage_categories_menu(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     
-    categories = get_all_categories()
+    categories = await get_all_categories()
     text = "📁 *إدارة الأقسام:*\n\n"
     if categories:
         for cat_id, name in categories:
@@ -798,7 +2828,7 @@ async def show_manage_categories_menu(cb: types.CallbackQuery):
     await cb.message.edit_text(text, parse_mode="Markdown", reply_markup=manage_categories_menu())
     await cb.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "add_category")
+@callbacks.exact("add_category")
 async def start_add_category(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     await cb.message.answer("أرسل اسم القسم الجديد:", reply_markup=manage_categories_menu())
@@ -807,17 +2837,19 @@ async def start_add_category(cb: types.CallbackQuery):
 
 @dp.message_handler(state=AddCategory.waiting_for_name)
 async def process_add_category(msg: types.Message, state: FSMContext):
-    if add_category_to_db(msg.text):
+    cat_id = await add_category_to_db(msg.text)
+    if cat_id:
+        catalog.add_category(cat_id, msg.text)
         await msg.answer("✔️ تم إضافة القسم بنجاح!", reply_markup=manage_categories_menu())
     else:
         await msg.answer("❌ هذا القسم موجود مسبقاً أو حدث خطأ.", reply_markup=manage_categories_menu())
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data == "delete_category")
+@callbacks.exact("delete_category")
 async def start_delete_category(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     
-    categories = get_all_categories()
+    categories = await get_all_categories()
     if not categories:
         await cb.message.answer("لا توجد أقسام لحذفها.")
         await cb.answer()
@@ -842,7 +2874,8 @@ async def process_delete_category(msg: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    if delete_category_from_db(cat_id):
+    if await delete_category_from_db(cat_id):
+        catalog.remove_category(cat_id)
         await msg.answer(f"✅ تم حذف القسم ذو ID `{cat_id}` بنجاح.\n*ملاحظة: تم نقل المنتجات المرتبطة به إلى حالة 'بدون قسم'*.", parse_mode="Markdown", reply_markup=manage_categories_menu())
     else:
         await msg.answer(f"❌ لم يتم العثور على قسم ذو ID `{cat_id}` للحذف.", reply_markup=manage_categories_menu())
@@ -852,11 +2885,11 @@ async def process_delete_category(msg: types.Message, state: FSMContext):
 
 # ------------ Admin: Custom Buttons Management ------------
 
-@dp.callback_query_handler(lambda c: c.data == "manage_custom_buttons")
+@callbacks.exact("manage_custom_buttons")
 async def show_manage_buttons_menu(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     
-    buttons = get_custom_buttons()
+    buttons = await get_custom_buttons()
     text = "🔗 *إدارة الأزرار المخصصة:*\n\n"
     if buttons:
         for btn_id, text_btn, url_btn in buttons:
@@ -867,7 +2900,7 @@ async def show_manage_buttons_menu(cb: types.CallbackQuery):
     await cb.message.edit_text(text, parse_mode="Markdown", reply_markup=manage_custom_buttons_menu())
     await cb.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "add_custom_button")
+@callbacks.exact("add_custom_button")
 async def start_add_button(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     await cb.message.answer("أرسل *نص* الزر الذي سيظهر للمستخدم:", parse_mode="Markdown", reply_markup=manage_custom_buttons_menu())
@@ -891,16 +2924,17 @@ async def button_url(msg: types.Message, state: FSMContext):
     data = await state.get_data()
     text = data["text"]
 
-    add_custom_button_to_db(text, url) 
+    await add_custom_button_to_db(text, url) 
+    await refresh_custom_buttons()
 
     await msg.answer("✔️ تم إضافة الزر المخصص بنجاح!", reply_markup=manage_custom_buttons_menu())
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data == "delete_custom_button")
+@callbacks.exact("delete_custom_button")
 async def start_delete_button(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     
-    buttons = get_custom_buttons()
+    buttons = await get_custom_buttons()
     if not buttons:
         await cb.message.answer("لا توجد أزرار لحذفها.")
         await cb.answer()
@@ -925,7 +2959,8 @@ async def process_delete_button(msg: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    if delete_custom_button_from_db(btn_id):
+    if await delete_custom_button_from_db(btn_id):
+        await refresh_custom_buttons()
         await msg.answer(f"✅ تم حذف الزر ذو ID `{btn_id}` بنجاح.", reply_markup=manage_custom_buttons_menu())
     else:
         await msg.answer(f"❌ لم يتم العثور على زر ذو ID `{btn_id}` للحذف.", reply_markup=manage_custom_buttons_menu())
@@ -934,17 +2969,17 @@ async def process_delete_button(msg: types.Message, state: FSMContext):
 
 
 # ------------ Admin: Product Management (CRUD) ------------
-@dp.callback_query_handler(lambda c: c.data == "manage_products")
+@callbacks.exact("manage_products")
 async def show_manage_products_menu(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     await cb.message.edit_text("➕ *إدارة المنتجات ➖*", parse_mode="Markdown", reply_markup=manage_products_menu())
     await cb.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "add_product")
+@callbacks.exact("add_product")
 async def start_add_product(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     
-    categories = get_all_categories()
+    categories = await get_all_categories()
     if not categories:
         await cb.message.answer("❌ يجب إضافة قسم واحد على الأقل قبل إضافة منتج. الرجاء إنشاء قسم أولاً.", reply_markup=manage_categories_menu())
         await cb.answer()
@@ -960,9 +2995,8 @@ async def start_add_product(cb: types.CallbackQuery):
     await AddProduct.waiting_for_category.set()
     await cb.answer() 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("select_cat_"), state=AddProduct.waiting_for_category)
-async def select_category(cb: types.CallbackQuery, state: FSMContext):
-    cat_id = int(cb.data.split('_')[2])
+@callbacks.prefix("select_cat_", int, state=AddProduct.waiting_for_category)
+async def select_category(cb: types.CallbackQuery, cat_id: int, state: FSMContext):
     await state.update_data(category_id=cat_id)
     await cb.message.edit_text(f"✅ تم اختيار القسم. الآن أرسل اسم المنتج:", reply_markup=manage_products_menu())
     await AddProduct.waiting_for_name.set()
@@ -986,31 +3020,52 @@ async def product_price(msg: types.Message, state: FSMContext):
     name = data["name"]
     category_id = data["category_id"]
 
-    add_product_to_db(name, price, category_id) 
+    pid = await add_product_to_db(name, price, category_id)
+    catalog.add_product(pid, name, price, category_id)
 
     await msg.answer("✔️ تم إضافة المنتج بنجاح!", reply_markup=manage_products_menu())
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data == "delete_product")
-async def start_delete_product(cb: types.CallbackQuery):
-    if cb.from_user.id != ADMIN_ID: return
-    
-    products = get_all_products()
+async def render_products_for_deletion(before_id=None):
+    page_size = CatalogSnapshot.page_size()
+    products = await get_products_page(before_id=before_id, limit=page_size)
     if not products:
-        await cb.message.answer("لا توجد منتجات لحذفها.")
-        await cb.answer()
-        return
+        return None, None
     
     text = "📦 *المنتجات المتوفرة:*\n\n"
     for pid, data in products.items():
         text += f"• *ID:* `{pid}` | {data['name']} | السعر: {data['price']}\n"
     
     text += "\nالرجاء إرسال *رقم ID* المنتج الذي تريد حذفه:"
+
+    kb = manage_products_menu()
+    if len(products) == page_size:
+        kb.add(InlineKeyboardButton("⬅️ المزيد من المنتجات", callback_data=f"delete_product_page_{min(products)}"))
+    return text, kb
+
+@callbacks.exact("delete_product")
+async def start_delete_product(cb: types.CallbackQuery):
+    if cb.from_user.id != ADMIN_ID: return
+    
+    text, kb = await render_products_for_deletion()
+    if not text:
+        await cb.message.answer("لا توجد منتجات لحذفها.")
+        await cb.answer()
+        return
     
-    await cb.message.answer(text, parse_mode="Markdown", reply_markup=manage_products_menu())
+    await cb.message.answer(text, parse_mode="Markdown", reply_markup=kb)
     await DeleteProduct.waiting_for_id.set()
     await cb.answer()
 
+@callbacks.prefix("delete_product_page_", int, state=DeleteProduct.waiting_for_id)
+async def page_delete_product(cb: types.CallbackQuery, before_id: int):
+    if cb.from_user.id != ADMIN_ID: return
+    
+    text, kb = await render_products_for_deletion(before_id)
+    if text:
+        await cb.message.edit_text(text, parse_mode="Markdown", reply_markup=kb)
+    await cb.answer()
+
 @dp.message_handler(state=DeleteProduct.waiting_for_id)
 async def process_delete_product(msg: types.Message, state: FSMContext):
     try:
@@ -1020,15 +3075,257 @@ async def process_delete_product(msg: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    if delete_product_from_db(product_id):
+    if await delete_product_from_db(product_id):
+        catalog.remove_product(product_id)
         await msg.answer(f"✅ تم حذف المنتج ذو ID `{product_id}` بنجاح.", reply_markup=manage_products_menu())
     else:
         await msg.answer(f"❌ لم يتم العثور على منتج ذو ID `{product_id}` للحذف.", reply_markup=manage_products_menu())
     
     await state.finish()
 
+@callbacks.exact("add_stock")
+async def start_add_stock(cb: types.CallbackQuery):
+    if cb.from_user.id != ADMIN_ID: return
+    await cb.message.answer("📥 *إضافة مخزون:*\n\nالرجاء إرسال *رقم ID* المنتج:", parse_mode="Markdown", reply_markup=manage_products_menu())
+    await AddStock.waiting_for_product_id.set()
+    await cb.answer()
+
+@dp.message_handler(state=AddStock.waiting_for_product_id)
+async def process_stock_product_id(msg: types.Message, state: FSMContext):
+    if msg.from_user.id != ADMIN_ID: return
+    try:
+        product_id = int(msg.text)
+    except (TypeError, ValueError):
+        await msg.answer("❌ الرجاء إرسال رقم ID صحيح.")
+        return
+    if product_id not in catalog.product_category:
+        await msg.answer(f"❌ لم يتم العثور على منتج ذو ID `{product_id}`.", parse_mode="Markdown")
+        return
+
+    await state.update_data(stock_product_id=product_id)
+    await msg.answer(
+        f"أرسل عناصر المخزون للمنتج `{product_id}`:\n"
+        "• نص: كل سطر = عنصر واحد (كود، بيانات دخول...)\n"
+        "• صورة أو ملف: كل رسالة = عنصر واحد\n\n"
+        "يمكنك إرسال عدة رسائل، ثم اضغط رجوع عند الانتهاء.",
+        parse_mode="Markdown", reply_markup=admin_menu()
+    )
+    await AddStock.waiting_for_items.set()
+
+@dp.message_handler(state=AddStock.waiting_for_items, content_types=[types.ContentType.TEXT, types.ContentType.PHOTO, types.ContentType.DOCUMENT])
+async def process_stock_items(msg: types.Message, state: FSMContext):
+    if msg.from_user.id != ADMIN_ID: return
+    product_id = (await state.get_data())['stock_product_id']
+
+    if msg.photo:
+        items = [('photo', msg.photo[-1].file_id)]
+    elif msg.document:
+        items = [('document', msg.document.file_id)]
+    else:
+        items = [('text', line.strip()) for line in msg.text.splitlines() if line.strip()]
+    if not items:
+        return
+
+    added = await add_stock_items(product_id, items)
+    if added is None:
+        await msg.answer("❌ المنتج لم يعد موجوداً.", reply_markup=manage_products_menu())
+        await state.finish()
+        return
+    available, version = added
+    catalog.update_stock(product_id, available, version)
+    await msg.answer(f"✅ تمت إضافة {len(items)} عنصر. المخزون المتاح الآن: {available}.")
+
+# ------------ Admin: Catalog Import/Export ------------
+CATALOG_IMPORT_FORMATS = {'.csv': 'csv', '.json': 'json', '.jsonl': 'jsonl'}
+
+@callbacks.exact("import_catalog")
+async def start_import_catalog(cb: types.CallbackQuery):
+    if cb.from_user.id != ADMIN_ID: return
+    await cb.message.answer(
+        "📂 *استيراد منتجات:*\n\n"
+        "أرسل ملف CSV أو JSON أو JSONL يحتوي الأعمدة: `name`, `price`, `category`\n"
+        "• العمود `id` اختياري: إن وُجد يُحدَّث المنتج بدلاً من إضافته.\n"
+        "• الأقسام غير الموجودة تُنشأ تلقائياً.\n"
+        "• ملف التصدير نفسه صالح للاستيراد بعد تعديله.",
+        parse_mode="Markdown", reply_markup=manage_products_menu()
+    )
+    await ImportCatalog.waiting_for_file.set()
+    await cb.answer()
+
+@dp.message_handler(state=ImportCatalog.waiting_for_file, content_types=types.ContentType.DOCUMENT)
+async def process_import_catalog(msg: types.Message, state: FSMContext):
+    if msg.from_user.id != ADMIN_ID: return
+    extension = os.path.splitext(msg.document.file_name or '')[1].lower()
+    fmt = CATALOG_IMPORT_FORMATS.get(extension)
+    if not fmt:
+        await msg.answer("❌ صيغة غير مدعومة. الرجاء إرسال ملف .csv أو .json أو .jsonl")
+        return
+
+    fd, path = tempfile.mkstemp(suffix=extension)
+    os.close(fd)
+    try:
+        await msg.document.download(destination_file=path)
+        started = time.perf_counter()
+        result = await import_catalog_file(path, fmt)
+    except (ValueError, UnicodeDecodeError, csv.Error, TelegramAPIError) as e:
+        await msg.answer(f"❌ فشل الاستيراد ولم يُحفظ أي شيء:\n{e}", reply_markup=manage_products_menu())
+        await state.finish()
+        return
+    finally:
+        os.remove(path)
+
+    await reload_catalog()
+    text = (
+        f"✅ اكتمل الاستيراد في {time.perf_counter() - started:.1f} ثانية:\n"
+        f"• منتجات جديدة: {result['inserted']}\n"
+        f"• منتجات محدَّثة: {result['updated']}\n"
+        f"• أقسام جديدة: {result['categories']}\n"
+        f"• صفوف متجاوزة: {result['skipped']}"
+    )
+    if result['errors']:
+        text += "\n\nأول الأخطاء (رقم السطر: السبب):\n" + "\n".join(result['errors'])
+    await msg.answer(text, reply_markup=manage_products_menu())
+    await state.finish()
+
+@dp.message_handler(state=ImportCatalog.waiting_for_file, content_types=types.ContentType.ANY)
+async def import_catalog_expects_file(msg: types.Message):
+    if msg.from_user.id != ADMIN_ID: return
+    await msg.answer("الرجاء إرسال الملف كمستند (CSV أو JSON أو JSONL)، أو اضغط رجوع.", reply_markup=manage_products_menu())
+
+@callbacks.exact("export_catalog")
+async def export_catalog(cb: types.CallbackQuery):
+    if cb.from_user.id != ADMIN_ID: return
+    await cb.answer("⏳ جاري تجهيز الملف...")
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        count = await export_catalog_csv(path)
+        filename = f"catalog-{datetime.now().strftime('%Y%m%d-%H%M')}.csv"
+        await bot.send_document(cb.from_user.id, types.InputFile(path, filename=filename),
+                                caption=f"💾 الكتالوج: {count} منتج")
+    finally:
+        os.remove(path)
+
+# ------------ Admin: Orders Export ------------
+DOCUMENT_SIZE_LIMIT = 50 * 1024 * 1024  # حد Bot API لإرسال المستندات
+ORDER_EXPORT_USAGE = (
+    "📤 *تصدير الطلبات:*\n\n"
+    "`/export_orders [csv|jsonl] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [status=...] [user=ID]`\n"
+    "• `status`: all أو pending أو delivered أو cancelled\n"
+    "• التواريخ بتوقيت UTC ويشمل `to` اليوم كاملاً.\n"
+    "• الملف مضغوط (gzip)، والافتراضي CSV لكل الطلبات."
+)
+
+def parse_order_export_args(args):
+    """تحويل وسائط /export_orders إلى (الصيغة، فلاتر iter_orders). يرفع ValueError برسالة للأدمن."""
+    fmt, filters = 'csv', {}
+    for token in args.split():
+        key, sep, value = token.partition('=')
+        key = key.lower()
+        if not sep and key in ('csv', 'jsonl'):
+            fmt = key
+        elif key in ('from', 'to'):
+            try:
+                day = datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f"تاريخ غير صالح: {value}")
+            if key == 'from':
+                filters['since'] = day.strftime('%Y-%m-%d')
+            else:
+                filters['until'] = (day + timedelta(days=1)).strftime('%Y-%m-%d')
+        elif key == 'status' and value.lower() in ORDER_HISTORY_FILTERS:
+            filters['status'], filters['delivery_status'], _ = ORDER_HISTORY_FILTERS[value.lower()]
+        elif key == 'user' and value.isdigit():
+            filters['user_id'] = int(value)
+        else:
+            raise ValueError(f"وسيط غير معروف: {token}")
+    return fmt, filters
+
+async def send_orders_export(chat_id, fmt='csv', filters=None):
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        count, revenue = await export_orders_file(path, fmt, filters or {})
+        elapsed = time.perf_counter() - started
+        logging.info("Exported %s orders to %s in %.2fs", count, fmt, elapsed)
+        if os.path.getsize(path) > DOCUMENT_SIZE_LIMIT:
+            await bot.send_message(chat_id, "❌ الملف أكبر من حد Telegram (50MB). الرجاء تضييق نطاق التصدير (from/to/status/user).")
+            return
+        filename = f"orders-{datetime.now().strftime('%Y%m%d-%H%M')}.{fmt}.gz"
+        caption = f"📤 الطلبات: {count} | إيرادات المكتملة: {revenue:.2f} {get_setting('currency_symbol')}"
+        await bot.send_document(chat_id, types.InputFile(path, filename=filename), caption=caption)
+    finally:
+        os.remove(path)
+
+@dp.message_handler(commands=['export_orders'], state="*")
+async def export_orders_command(msg: types.Message):
+    if msg.from_user.id != ADMIN_ID: return
+    try:
+        fmt, filters = parse_order_export_args(msg.get_args() or '')
+    except ValueError as e:
+        await msg.answer(f"❌ {e}\n\n{ORDER_EXPORT_USAGE}", parse_mode="Markdown")
+        return
+    await msg.answer("⏳ جاري تجهيز ملف الطلبات...")
+    await send_orders_export(msg.chat.id, fmt, filters)
+
+@callbacks.exact("export_orders")
+async def export_orders(cb: types.CallbackQuery):
+    if cb.from_user.id != ADMIN_ID: return
+    # تصدير الجدول كاملاً قد يكون ملايين الصفوف، فلا يبدأ إلا بتأكيد صريح
+    kb = InlineKeyboardMarkup().add(
+        InlineKeyboardButton("📤 تصدير كل الطلبات (CSV)", callback_data="export_orders_all"),
+        InlineKeyboardButton("رجوع إلى قائمة الأدمن ⬅️", callback_data="admin_main_menu")
+    )
+    await cb.message.answer(ORDER_EXPORT_USAGE, parse_mode="Markdown", reply_markup=kb)
+    await cb.answer()
+
+@callbacks.exact("export_orders_all")
+async def export_all_orders(cb: types.CallbackQuery):
+    if cb.from_user.id != ADMIN_ID: return
+    await cb.answer("⏳ جاري تجهيز الملف...")
+    await send_orders_export(cb.from_user.id)
+
+# ------------ Admin: User Order History ------------
+async def send_admin_order_history(msg: types.Message, raw_user_id):
+    try:
+        user_id = int(raw_user_id)
+    except (TypeError, ValueError):
+        await msg.answer("❌ الرجاء إرسال رقم ID صحيح.")
+        return False
+    text, kb = await render_order_history(user_id, for_admin=True)
+    balance = await get_user_balance(user_id)
+    text = f"💰 الرصيد الحالي: {balance:.2f} {get_setting('currency_symbol')}\n" + text
+    await msg.answer(text, parse_mode="HTML", reply_markup=kb)
+    return True
+
+@callbacks.exact("lookup_user_orders")
+async def start_lookup_user_orders(cb: types.CallbackQuery):
+    if cb.from_user.id != ADMIN_ID: return
+    await cb.message.answer("🔎 *سجل طلبات مستخدم:*\n\nالرجاء إرسال ID المستخدم (أو استخدم `/orders ID`):", parse_mode="Markdown", reply_markup=admin_menu())
+    await AdminOrderLookup.waiting_for_user_id.set()
+    await cb.answer()
+
+@dp.message_handler(state=AdminOrderLookup.waiting_for_user_id)
+async def process_lookup_user_orders(msg: types.Message, state: FSMContext):
+    if msg.from_user.id != ADMIN_ID: return
+    if await send_admin_order_history(msg, msg.text):
+        await state.finish()
+
+@dp.message_handler(commands=['orders'], state="*")
+async def admin_orders_command(msg: types.Message):
+    if msg.from_user.id != ADMIN_ID: return
+    await send_admin_order_history(msg, msg.get_args())
+
+@callbacks.prefix("ahistory_", int, str, int)
+async def page_admin_order_history(cb: types.CallbackQuery, user_id: int, filter_key: str, before_id: int):
+    if cb.from_user.id != ADMIN_ID: return
+    text, kb = await render_order_history(user_id, filter_key, before_id, for_admin=True)
+    await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await cb.answer()
+
 # ------------ Admin: Balance Management ------------
-@dp.callback_query_handler(lambda c: c.data == "manage_balance")
+@callbacks.exact("manage_balance")
 async def start_manage_balance(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID: return
     await cb.message.answer("💰 *إدارة الرصيد:*\n\nالرجاء إرسال ID المستخدم الذي تريد تعديل رصيده:", parse_mode="Markdown", reply_markup=admin_menu())
@@ -1040,7 +3337,7 @@ async def get_target_id_for_balance(msg: types.Message, state: FSMContext):
     try:
         target_id = int(msg.text)
         await state.update_data(target_id=target_id)
-        current_balance = get_user_balance(target_id)
+        current_balance = await get_user_balance(target_id)
         currency = get_setting('currency_symbol')
         
         await msg.answer(f"تم اختيار المستخدم ID: `{target_id}`. رصيده الحالي: *{current_balance:.2f} {currency}*.\n\nالرجاء إرسال *قيمة التعديل* (موجب للإضافة، سالب للخصم). مثال: `+50` أو `-10`", parse_mode="Markdown")
@@ -1065,8 +3362,8 @@ async def process_balance_amount(msg: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    update_user_balance(target_id, amount)
-    new_balance = get_user_balance(target_id)
+    await update_user_balance(target_id, amount, actor_id=msg.from_user.id)
+    new_balance = await get_user_balance(target_id)
     currency = get_setting('currency_symbol')
 
     await msg.answer(f"✅ تم تعديل رصيد المستخدم ID: `{target_id}` بنجاح.\nالرصيد الجديد: *{new_balance:.2f} {currency}*.", parse_mode="Markdown", reply_markup=admin_menu())
@@ -1080,61 +3377,133 @@ async def process_balance_amount(msg: types.Message, state: FSMContext):
     
     await state.finish()
 
+@dp.message_handler(commands=['ledger'], state="*")
+async def show_user_ledger(msg: types.Message):
+    if msg.from_user.id != ADMIN_ID: return
+    try:
+        user_id = int(msg.get_args())
+    except ValueError:
+        await msg.answer("الاستخدام: /ledger ID")
+        return
+    entries = await get_ledger_entries(user_id)
+    currency = get_setting('currency_symbol')
+    text = f"📒 سجل رصيد المستخدم {user_id} (آخر {len(entries)} قيد):\n\n"
+    for entry_id, entry_type, amount, balance_after, order_id, actor_id, created_at in entries:
+        text += f"#{entry_id} {created_at[:16]} | {LEDGER_ENTRY_TYPES.get(entry_type, entry_type)}: {amount:+.2f} → {balance_after:.2f} {currency}"
+        if order_id:
+            text += f" | طلب #{order_id}"
+        if entry_type == 'admin_adjust' and actor_id:
+            text += f" | بواسطة {actor_id}"
+        text += "\n"
+    if not entries:
+        text += "لا توجد قيود."
+    await msg.answer(text)
+
+@dp.message_handler(commands=['reconcile'], state="*")
+async def reconcile_balances_command(msg: types.Message):
+    if msg.from_user.id != ADMIN_ID: return
+    started = time.perf_counter()
+    checked, mismatches = await run_ledger_reconciliation()
+    text = f"🧾 تدقيق الأرصدة ({time.perf_counter() - started:.2f} ثانية):\n• قيود جديدة مدققة: {checked}\n"
+    if mismatches:
+        text += "• فروقات:\n" + format_ledger_mismatches(mismatches)
+    else:
+        text += "• لا توجد فروقات ✅"
+    await msg.answer(text)
+
 
 # ------------ Buying System (with Cancellation Feature) ------------
+async def send_stock_item(user_id, order_id, item):
+    caption = f"📦 تفاصيل طلبك رقم {order_id}"
+    if item['kind'] == 'photo':
+        await bot.send_photo(user_id, item['content'], caption=caption)
+    elif item['kind'] == 'document':
+        await bot.send_document(user_id, item['content'], caption=caption)
+    else:
+        await bot.send_message(user_id, f"{caption}:\n\n<code>{html.escape(item['content'])}</code>", parse_mode="HTML")
+
+async def complete_instant_purchase(cb, pid, product, result, user_link):
+    """تسليم العنصر المحجوز فوراً؛ عند فشل الإرسال يبقى الطلب Pending للتسليم اليدوي."""
+    order_id = result['order_id']
+    currency = get_setting('currency_symbol')
+    catalog.update_stock(pid, result['stock_left'], result['stock_version'])
+
+    await cb.message.answer(
+        f"✅ تم شراء المنتج *{product['name']}* بنجاح.\n"
+        f"تم خصم: {product['price']} {currency}.\n"
+        f"رصيدك الجديد هو: *{result['balance']:.2f} {currency}*.",
+        parse_mode="Markdown",
+        reply_markup=back_button_user()
+    )
+    try:
+        await send_stock_item(cb.from_user.id, order_id, result['item'])
+    except TelegramAPIError as e:
+        logging.warning("Instant delivery of order %s failed: %s", order_id, e)
+        kb_admin = InlineKeyboardMarkup().add(InlineKeyboardButton(f"📦 تسليم الطلب {order_id}", callback_data=f"deliver_{order_id}"))
+        await notify(ADMIN_ID,
+                     f"⚠️ فشل التسليم الفوري للطلب <code>{order_id}</code> ({html.escape(product['name'])}) "
+                     f"إلى {user_link}: {html.escape(str(e))}\nالعنصر محجوز للطلب، الرجاء التسليم يدوياً.",
+                     parse_mode="HTML", reply_markup=kb_admin)
+    else:
+        await update_order_delivery_status(order_id, 'Delivered')
+        await notify(ADMIN_ID,
+                     f"⚡ بيع وتسليم فوري: {html.escape(product['name'])} (ID: {pid}) بسعر {product['price']} {currency}\n"
+                     f"المشتري: {user_link} | الطلب <code>{order_id}</code> | المخزون المتبقي: {result['stock_left']}",
+                     parse_mode="HTML")
+
+    try:
+        threshold = int(get_setting('low_stock_threshold'))
+    except (TypeError, ValueError):
+        threshold = 0
+    if result['stock_left'] == 0:
+        await notify(ADMIN_ID, f"🚨 نفد مخزون المنتج {html.escape(product['name'])} (ID: {pid}). الطلبات القادمة ستحتاج تسليماً يدوياً.", parse_mode="HTML")
+    elif result['stock_left'] == threshold:
+        await notify(ADMIN_ID, f"⚠️ مخزون المنتج {html.escape(product['name'])} (ID: {pid}) منخفض: بقي {threshold} فقط.", parse_mode="HTML")
+    await cb.answer()
+
 # ... (تم نقل دالة الشراء إلى الأعلى في الكود السابق، ولكنها ستحفظ هنا لتسلسل الكود) ...
-@dp.callback_query_handler(lambda c: c.data.startswith("buy_"))
-async def buy_item(cb: types.CallbackQuery):
-    pid = int(cb.data.split("_")[1])
-    product = get_product_by_id(pid)
+@callbacks.prefix("buy_", int)
+async def buy_item(cb: types.CallbackQuery, pid: int):
     user_id = cb.from_user.id
-    current_balance = get_user_balance(user_id)
     currency = get_setting('currency_symbol')
     minutes = get_setting('cancellation_time_minutes')
 
-    if not product:
+    touch_user(user_id)
+    result = await purchase_product(user_id, pid)
+
+    if result['status'] == 'not_found':
         await cb.message.answer("❌ المنتج غير موجود!")
         await cb.answer()
         return
 
-    price = product['raw_price']
-    
-    if current_balance < price:
+    product = result['product']
+
+    if result['status'] == 'insufficient':
         await cb.message.answer(
-            f"❌ رصيدك الحالي ({current_balance:.2f} {currency}) لا يكفي لشراء {product['name']} ({product['price']} {currency}).\n"
+            f"❌ رصيدك الحالي ({result['balance']:.2f} {currency}) لا يكفي لشراء {product['name']} ({product['price']} {currency}).\n"
             "الرجاء إيداع المزيد من الرصيد.",
             reply_markup=back_button_user()
         )
         await cb.answer()
         return
 
-    update_user_balance(user_id, -price) 
-    order_id = record_order(user_id, product['name'], price, is_cancellable=True) 
+    order_id = result['order_id']
+    new_balance = result['balance']
+    user_link = f"<a href='tg://user?id={cb.from_user.id}'>{cb.from_user.full_name}</a>"
 
-    new_balance = get_user_balance(user_id)
-    
-    kb_user = InlineKeyboardMarkup(row_width=1)
-    kb_user.add(InlineKeyboardButton(f"❌ إلغاء الطلب (مهلة {minutes} دقيقة)", callback_data=f"cancel_{order_id}"))
-    kb_user.add(InlineKeyboardButton("القائمة الرئيسية 🏠", callback_data="user_main_menu"))
-    
-    await cb.message.answer(
-        f"✅ تم شراء المنتج *{product['name']}* بنجاح.\n"
-        f"تم خصم: {product['price']} {currency}.\n"
-        f"رصيدك الجديد هو: *{new_balance:.2f} {currency}*.\n\n"
-        f"💬 سيتم إرسال تفاصيل المنتج إليك قريباً.\n"
-        f"⚠️ لديك {minutes} دقيقة لإلغاء الطلب واسترداد الرصيد.",
-        parse_mode="Markdown",
-        reply_markup=kb_user
-    )
+    if result['item']:
+        await complete_instant_purchase(cb, pid, product, result, user_link)
+        return
 
-    user_link = f"<a href='tg://user?id={cb.from_user.id}'>{cb.from_user.full_name}</a>"
-    
+    remember_cancellable_order(user_id, order_id, result['expiry_time'])
+
+    # إشعار الأدمن يُحفظ في الطابور قبل الرد، ويرسله العامل الخلفي
     kb_admin = InlineKeyboardMarkup(row_width=1)
     kb_admin.add(
-        InlineKeyboardButton("📦 تسليم المنتج الآن", callback_data=f"deliver_{order_id}")
+        InlineKeyboardButton(f"📦 تسليم الطلب {order_id}", callback_data=f"deliver_{order_id}")
     )
     
-    await bot.send_message(
+    await notify(
         ADMIN_ID,
         f"🎉 *عملية شراء جديدة (قيد التسليم):*\n\n"
         f"المنتج: {product['name']} (ID: {pid})\n"
@@ -1145,14 +3514,27 @@ async def buy_item(cb: types.CallbackQuery):
         parse_mode="HTML",
         reply_markup=kb_admin
     )
+    
+    kb_user = InlineKeyboardMarkup(row_width=1)
+    kb_user.add(InlineKeyboardButton(f"❌ إلغاء الطلب (مهلة {minutes} دقيقة)", callback_data=f"cancel_{order_id}"))
+    kb_user.add(InlineKeyboardButton("القائمة الرئيسية 🏠", callback_data="user_main_menu"))
+    
+    await cb.message.answer(
+        f"✅ تم شراء المنتج *{product['name']}* بنجاح.\n"
+        f"تم خصم: {product['price']} {currency}.\n"
+        f"رصيدك الجديد هو: *{new_balance:.2f} {currency}*.\n\n"
+        f"💬 سيتم إرسال تفاصيل المنتج إليك قريباً.\n"
+        f"⚠️ لديك {minutes} دقيقة لإلغاء الطلب واسترداد الرصيد.",
+        parse_mode="Markdown",
+        reply_markup=kb_user
+    )
     await cb.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cancel_"))
-async def handle_cancel_order(cb: types.CallbackQuery):
-    order_id = int(cb.data.split('_')[1])
+@callbacks.prefix("cancel_", int)
+async def handle_cancel_order(cb: types.CallbackQuery, order_id: int):
     user_id = cb.from_user.id
     
-    order_data = get_cancellable_order(user_id)
+    order_data = await get_cancellable_order(user_id)
     
     if not order_data or order_data[0] != order_id:
         await cb.message.answer("❌ لا يمكن إلغاء هذا الطلب. قد تكون المهلة قد انتهت أو تم تسليمه بالفعل.")
@@ -1163,30 +3545,34 @@ async def handle_cancel_order(cb: types.CallbackQuery):
     price = order_data[2]
     currency = get_setting('currency_symbol')
     
-    if cancel_pending_order(order_id, user_id, price):
+    if await cancel_pending_order(order_id, user_id, price):
+        forget_cancellable_order(user_id, order_id)
+        older_order = await get_cancellable_order(user_id)
+        if older_order:
+            remember_cancellable_order(user_id, older_order[0], older_order[3])
+        user_link = f"<a href='tg://user?id={user_id}'>{cb.from_user.full_name}</a>"
+        await notify(ADMIN_ID, 
+                     f"🔔 *إشعار إلغاء:* \nقام المستخدم {user_link} (`{user_id}`) بإلغاء الطلب `{order_id}`.", 
+                     parse_mode="HTML")
         await cb.message.edit_text(
             f"✅ تم إلغاء طلبك للمنتج *{product_name}* بنجاح.\n"
             f"تمت إعادة {price:.2f} {currency} إلى رصيدك.",
             parse_mode="Markdown",
             reply_markup=back_button_user()
         )
-        
-        user_link = f"<a href='tg://user?id={user_id}'>{cb.from_user.full_name}</a>"
-        await bot.send_message(ADMIN_ID, 
-                               f"🔔 *إشعار إلغاء:* \nقام المستخدم {user_link} (`{user_id}`) بإلغاء الطلب `{order_id}`.", 
-                               parse_mode="HTML")
     else:
-        await cb.message.answer("❌ فشل الإلغاء. الرجاء التواصل مع الدعم.")
+        # سبقتها ضغطة أخرى أو انتهت المهلة بين القراءة والإلغاء
+        forget_cancellable_order(user_id, order_id)
+        await cb.message.answer("❌ لا يمكن إلغاء هذا الطلب. قد تكون المهلة قد انتهت أو تم تسليمه بالفعل.")
         
     await cb.answer()
     
 # ------------ Admin: Delivery Flow ------------
-@dp.callback_query_handler(lambda c: c.data.startswith("deliver_"))
-async def start_delivery(cb: types.CallbackQuery, state: FSMContext):
+@callbacks.prefix("deliver_", int)
+async def start_delivery(cb: types.CallbackQuery, order_id: int, state: FSMContext):
     if cb.from_user.id != ADMIN_ID: return
     
-    order_id = int(cb.data.split('_')[1])
-    order_details = get_order_details(order_id)
+    order_details = await get_order_details(order_id)
 
     if not order_details:
         await cb.message.answer("❌ الطلب غير موجود أو تم إلغاؤه.")
@@ -1221,7 +3607,7 @@ async def process_delivery_data(msg: types.Message, state: FSMContext):
         await bot.send_message(target_user_id, f"✅ *اكتمل التسليم!* \nتم إرسال تفاصيل طلبك رقم `{order_id}`. شكراً لك.", parse_mode="Markdown")
         
         # تحديث حالة الطلب
-        update_order_delivery_status(order_id, 'Delivered')
+        await update_order_delivery_status(order_id, 'Delivered')
         
         await msg.answer(f"✅ تم تسليم الطلب رقم `{order_id}` بنجاح إلى المستخدم ID `{target_user_id}`.", reply_markup=admin_menu())
         
@@ -1230,61 +3616,271 @@ async def process_delivery_data(msg: types.Message, state: FSMContext):
 
     await state.finish()
 
+# ------------ Product Search ------------
+SEARCH_QUERY_MAX_LENGTH = 100
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", "200"))  # حد الترقيم (OFFSET)
+
+async def render_search_results(query, offset=0):
+    size = CatalogSnapshot.page_size()
+    rows = await search_products(query, offset, size + 1)
+    has_next = len(rows) > size and offset + size < SEARCH_MAX_RESULTS
+    rows = rows[:size]
+    currency = get_setting('currency_symbol')
+
+    kb = InlineKeyboardMarkup(row_width=1)
+    if not rows:
+        text = f"🔍 لا توجد نتائج لـ «{html.escape(query)}».\nجرّب كلمة أخرى أو جزءاً من اسم المنتج."
+    else:
+        text = f"🔍 <b>نتائج البحث عن:</b> {html.escape(query)}\n\n"
+        for pid, name, price in rows:
+            stock = catalog.stock.get(pid)
+            stock_info = f" | المخزون: {stock} ⚡" if stock else ""
+            text += f"• <b>{html.escape(name)}</b>\n   السعر: {price:.2f} {currency}{stock_info}\n"
+            kb.add(InlineKeyboardButton(f"{'⚡ ' if stock else ''}شراء {name} ({price:.2f} {currency})", callback_data=f"buy_{pid}"))
+        nav = []
+        if offset:
+            nav.append(InlineKeyboardButton("السابق ➡️", callback_data=f"search_page_{max(offset - size, 0)}"))
+        if has_next:
+            nav.append(InlineKeyboardButton("⬅️ التالي", callback_data=f"search_page_{offset + size}"))
+        if nav:
+            kb.row(*nav)
+    kb.add(InlineKeyboardButton("🔍 بحث جديد", callback_data="search_products"))
+    kb.add(InlineKeyboardButton("القائمة الرئيسية 🏠", callback_data="user_main_menu"))
+    return text, kb
+
+async def answer_search(msg: types.Message, state: FSMContext, query):
+    query = query.strip()[:SEARCH_QUERY_MAX_LENGTH]
+    # النص يبقى في بيانات FSM (دون حالة) لأزرار التنقل بين الصفحات
+    await state.reset_state(with_data=False)
+    await state.update_data(search_query=query)
+    text, kb = await render_search_results(query)
+    await msg.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@dp.message_handler(commands=['search'], state="*")
+async def search_command(msg: types.Message, state: FSMContext):
+    query = msg.get_args()
+    if not query:
+        await msg.answer("🔍 أرسل اسم المنتج أو جزءاً منه:", reply_markup=back_button_user())
+        await SearchFlow.waiting_for_query.set()
+        return
+    await answer_search(msg, state, query)
+
+@callbacks.exact("search_products", state="*")
+async def start_search(cb: types.CallbackQuery):
+    await cb.message.edit_text("🔍 *بحث عن منتج:*\n\nأرسل اسم المنتج أو جزءاً منه:", parse_mode="Markdown", reply_markup=back_button_user())
+    await SearchFlow.waiting_for_query.set()
+    await cb.answer()
+
+@dp.message_handler(state=SearchFlow.waiting_for_query)
+async def process_search_query(msg: types.Message, state: FSMContext):
+    await answer_search(msg, state, msg.text)
+
+@callbacks.prefix("search_page_", int, state="*")
+async def search_page(cb: types.CallbackQuery, offset: int, state: FSMContext):
+    query = (await state.get_data()).get('search_query')
+    if not query:
+        await cb.answer("انتهت صلاحية نتائج البحث، ابدأ بحثاً جديداً.", show_alert=True)
+        return
+    text, kb = await render_search_results(query, min(max(offset, 0), SEARCH_MAX_RESULTS))
+    await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await cb.answer()
+
+# ------------ Inline Mode ------------
+# @bot <نص> من أي محادثة: النتائج من فهرس الكتالوج في الذاكرة دون أي استعلام لقاعدة البيانات.
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "300"))
+INLINE_PAGE_SIZE = 20  # الحد الأقصى في Telegram هو 50
+
+@dp.inline_handler(state="*")
+async def inline_catalog(query: types.InlineQuery):
+    try:
+        offset = max(int(query.offset or 0), 0)
+    except ValueError:
+        offset = 0
+    pids = catalog.search(query.query[:SEARCH_QUERY_MAX_LENGTH])
+    page = pids[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(pids) else ""
+
+    username = (await bot.me).username
+    await query.answer(
+        [catalog.inline_result(pid, username) for pid in page],
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=next_offset,
+    )
+
 # ------------ Show Products (Multi-level) ------------
 
-@dp.callback_query_handler(lambda c: c.data == "show_categories")
+@callbacks.exact("show_categories")
 async def show_categories_for_user(cb: types.CallbackQuery):
-    categories = get_all_categories()
+    view = catalog.categories_view()
     
-    if not categories:
+    if not view:
         await cb.message.edit_text("لا توجد أقسام متاحة حالياً.", reply_markup=back_button_user())
         await cb.answer()
         return
         
-    text = "📦 *الأقسام المتاحة:*\n\nالرجاء اختيار قسم لعرض المنتجات داخله:"
-    kb = InlineKeyboardMarkup(row_width=1)
-    
-    for cat_id, name in categories:
-        kb.add(InlineKeyboardButton(f"📁 {name}", callback_data=f"view_products_{cat_id}"))
-        
-    kb.add(InlineKeyboardButton("رجوع إلى القائمة الرئيسية 🏠", callback_data="user_main_menu"))
+    text, kb = view
+    await cb.message.edit_text(text, reply_markup=kb, parse_mode="Markdown")
+    await cb.answer()
+
+@callbacks.prefix("view_products_", int, int)
+async def show_products_in_category(cb: types.CallbackQuery, cat_id: int, cursor: int = 0):
+    text, kb = catalog.category_view(cat_id, cursor, is_admin=cb.from_user.id == ADMIN_ID)
     
     await cb.message.edit_text(text, reply_markup=kb, parse_mode="Markdown")
     await cb.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_products_"))
-async def show_products_in_category(cb: types.CallbackQuery):
-    cat_id = int(cb.data.split('_')[2])
-    products = get_all_products(cat_id)
-    category_name = get_category_name(cat_id)
-    currency = get_setting('currency_symbol')
-    is_admin = cb.from_user.id == ADMIN_ID
+# ------------ Background Tasks ------------
+EXPIRY_SWEEP_INTERVAL = int(os.environ.get("EXPIRY_SWEEP_INTERVAL", "60"))
+FSM_SWEEP_INTERVAL = int(os.environ.get("FSM_SWEEP_INTERVAL", str(60 * 60)))
 
-    if not products:
-        await cb.message.edit_text(f"📦 *قسم: {category_name}*\n\nلا توجد منتجات في هذا القسم حالياً.", reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️ رجوع للأقسام", callback_data="show_categories")))
-        await cb.answer()
-        return
+_background_tasks = set()
+_metrics_runner = None
 
-    text = f"📦 *قسم: {category_name}* ({len(products)} منتج)\n\n"
-    kb = InlineKeyboardMarkup(row_width=1)
+def start_background_task(coro):
+    """تشغيل مهمة خلفية مع الاحتفاظ بمرجع لها حتى تُلغى عند الإيقاف."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
-    for pid, data in products.items():
-        admin_info = f"(ID: {pid}) " if is_admin else ""
-        text += f"• **{admin_info}{data['name']}**\n   السعر: {data['price']} {currency}\n"
-        kb.add(InlineKeyboardButton(f"شراء {data['name']} ({data['price']} {currency})", callback_data=f"buy_{pid}"))
+async def expiry_sweeper():
+    """حذف نوافذ الإلغاء المنتهية دورياً ليبقى جدول cancellable_orders بحجم النوافذ الحية فقط."""
+    while True:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            expired = await expire_cancellation_windows(now)
+            if expired:
+                logging.info("Closed %s expired cancellation windows", expired)
+        except Exception:
+            logging.exception("Cancellation expiry sweep failed")
+        prune_pending_cancellations(now)
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+
+async def fsm_state_sweeper(storage):
+    while True:
+        try:
+            evicted = await storage.evict_expired()
+            if evicted:
+                logging.info("Evicted %s abandoned FSM states", evicted)
+        except Exception:
+            logging.exception("FSM state sweep failed")
+        await asyncio.sleep(FSM_SWEEP_INTERVAL)
+
+async def throttle_sweeper():
+    while True:
+        await asyncio.sleep(THROTTLE_SWEEP_INTERVAL)
+        evicted = throttling.evict_idle()
+        if evicted:
+            logging.info("Evicted %s idle throttling buckets", evicted)
+
+async def on_startup(dispatcher):
+    global _metrics_runner
+    if METRICS_PORT:
+        try:
+            _metrics_runner = await start_metrics_server()
+        except OSError as e:
+            # المقاييس اختيارية: منفذ مشغول لا يجب أن يمنع تشغيل البوت
+            logging.error("Metrics server disabled, cannot listen on %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+    await resume_broadcasts()
+    start_background_task(activity_flusher())
+    start_background_task(expiry_sweeper())
+    start_background_task(fsm_state_sweeper(dispatcher.storage))
+    start_background_task(throttle_sweeper())
+    start_background_task(notification_worker())
+    start_background_task(ledger_reconciler())
+
+async def on_shutdown(dispatcher):
+    # المهام الخلفية تحفظ تقدمها في قاعدة البيانات، لذا يكفي إلغاؤها هنا
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await flush_user_activity()
+    if _metrics_runner:
+        await _metrics_runner.cleanup()
+    await dispatcher.storage.close()
+    await dispatcher.storage.wait_closed()
+    session = await dispatcher.bot.get_session()
+    await session.close()
+
+# ------------ Webhook Mode ------------
+# وضع webhook: خادم aiohttp محلي (خلف reverse proxy عادةً) يستقبل التحديثات،
+# وكل طلب HTTP يُعالَج في مهمته الخاصة فتُعالَج التحديثات بالتوازي.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # العنوان العام، مثال: https://example.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "127.0.0.1")
+WEBAPP_PORT = int(os.environ.get("WEBAPP_PORT", "8080"))
+
+async def handle_webhook(request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    try:
+        update = types.Update(**(await request.json()))
+    except (TypeError, ValueError):
+        # جسم ليس JSON، أو JSON ليس كائناً (مثل [1])
+        return web.Response(status=400)
 
-    kb.add(InlineKeyboardButton("⬅️ رجوع للأقسام", callback_data="show_categories"))
-    kb.add(InlineKeyboardButton("القائمة الرئيسية 🏠", callback_data="user_main_menu"))
-    
-    await cb.message.edit_text(text, reply_markup=kb, parse_mode="Markdown")
-    await cb.answer()
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    try:
+        await dp.process_update(update)
+    except Exception:
+        # نرد بـ 200 حتى لا يعيد Telegram إرسال تحديث يفشل دائماً
+        logging.exception("Failed to process update %s", update.update_id)
+    return web.Response()
+
+async def run_webhook(stop_event):
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS,
+                              secret_token=WEBHOOK_SECRET)
+    logging.info("Serving webhook on http://%s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+
+    try:
+        await stop_event.wait()
+    finally:
+        # إيقاف استقبال طلبات جديدة مع انتظار اكتمال التحديثات الجارية
+        await runner.cleanup()
+
+async def main(mode="polling"):
+    stop_event = asyncio.Event()
+
+    def request_stop():
+        stop_event.set()
+        dp.stop_polling()
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, request_stop)
+    except NotImplementedError:
+        pass  # Windows
+
+    await on_startup(dp)
+    try:
+        if mode == "webhook":
+            await run_webhook(stop_event)
+        else:
+            await dp.start_polling()
+    finally:
+        await on_shutdown(dp)
 
 # ------------ Run Bot ------------
 if __name__ == '__main__':
+    # الوضع: polling (افتراضي) أو webhook، من سطر الأوامر أو من BOT_MODE
+    mode = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("BOT_MODE", "polling")
     init_db()
     try:
         # البدء باستخدام asyncio بدلاً من executor.start_polling
-        dp.loop.run_until_complete(dp.start_polling(bot))
-    except RuntimeError as e:
-        # هذا الجزء للتعامل مع أخطاء الإغلاق الشائعة عند التشغيل في بعض البيئات
+        asyncio.run(main(mode))
+    except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        close_db()